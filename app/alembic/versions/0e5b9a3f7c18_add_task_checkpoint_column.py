@@ -0,0 +1,25 @@
+"""add task checkpoint column
+
+Revision ID: 0e5b9a3f7c18
+Revises: f8c27e4a9d16
+Create Date: 2026-10-18 19:52:37.409126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# revision identifiers, used by Alembic.
+revision = '0e5b9a3f7c18'
+down_revision = 'f8c27e4a9d16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('checkpoint', JSONB, nullable=True))
+
+
+def downgrade():
+    op.drop_column('tasks', 'checkpoint')
@@ -0,0 +1,32 @@
+"""create failed downloads table
+
+Revision ID: 4b7e2d9a1c3f
+Revises: c5521d5c2307
+Create Date: 2026-10-18 09:12:40.518203
+
+"""
+from alembic import op
+from sqlalchemy import Column, DateTime, Integer, String
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2d9a1c3f'
+down_revision = 'c5521d5c2307'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'failed_downloads',
+        Column('path', String, primary_key=True),
+        Column('url', String, nullable=False),
+        Column('shortcode', String, index=True, nullable=True),
+        Column('reason', String, nullable=True),
+        Column('attempts', Integer, nullable=False),
+        Column('last_attempt', DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('failed_downloads')
@@ -0,0 +1,36 @@
+"""add profile trigram indexes
+
+Revision ID: 5f0d8b6e2c47
+Revises: e3a1c7f04d52
+Create Date: 2026-10-18 15:02:44.610931
+
+"""
+from alembic import op
+
+from migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0d8b6e2c47'
+down_revision = 'e3a1c7f04d52'
+branch_labels = None
+depends_on = None
+
+columns = ['username', 'full_name', 'display_name']
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in columns:
+        create_index_concurrently(
+            f'ix_profiles_{column}_trgm',
+            'profiles',
+            [column],
+            postgresql_using='gin',
+            postgresql_ops={column: 'gin_trgm_ops'},
+        )
+
+
+def downgrade():
+    for column in columns:
+        drop_index_concurrently(f'ix_profiles_{column}_trgm', 'profiles')
@@ -0,0 +1,44 @@
+"""add profile sync watermark columns
+
+Revision ID: 6a8f1d2c4b97
+Revises: 0e5b9a3f7c18
+Create Date: 2026-10-18 20:34:58.120446
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a8f1d2c4b97'
+down_revision = '0e5b9a3f7c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('profiles', sa.Column('sync_watermark_timestamp', sa.DateTime, nullable=True))
+    op.add_column('profiles', sa.Column('sync_watermark_shortcode', sa.String, nullable=True))
+    op.add_column('profiles', sa.Column('last_synced', sa.DateTime(timezone=True), nullable=True))
+
+    # start the watermarks at the newest archived post of each profile
+    op.execute(
+        """
+        UPDATE profiles
+        SET sync_watermark_timestamp = newest_posts.timestamp,
+            sync_watermark_shortcode = newest_posts.shortcode
+        FROM (
+            SELECT DISTINCT ON (username) username, timestamp, shortcode
+            FROM posts
+            WHERE username IS NOT NULL
+            ORDER BY username, timestamp DESC, shortcode DESC
+        ) AS newest_posts
+        WHERE profiles.username = newest_posts.username
+        """
+    )
+
+
+def downgrade():
+    op.drop_column('profiles', 'last_synced')
+    op.drop_column('profiles', 'sync_watermark_shortcode')
+    op.drop_column('profiles', 'sync_watermark_timestamp')
@@ -0,0 +1,48 @@
+"""create profile post stats table
+
+Revision ID: 9c2e5f8b3a61
+Revises: 4b7e2d9a1c3f
+Create Date: 2026-10-18 11:03:27.904517
+
+"""
+from alembic import op
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+
+
+# revision identifiers, used by Alembic.
+revision = '9c2e5f8b3a61'
+down_revision = '4b7e2d9a1c3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'profile_post_stats',
+        Column('username', String, ForeignKey('profiles.username', ondelete='CASCADE'), primary_key=True),
+        Column('year', Integer, primary_key=True),
+        Column('quarter', Integer, primary_key=True),
+        Column('count', Integer, nullable=False),
+        Column('first_post_timestamp', DateTime, nullable=False),
+        Column('last_post_timestamp', DateTime, nullable=False),
+    )
+
+    # backfill stats of existing posts
+    op.execute(
+        """
+        INSERT INTO profile_post_stats (username, year, quarter, count, first_post_timestamp, last_post_timestamp)
+        SELECT username,
+               CAST(date_part('year', timestamp) AS INTEGER),
+               CAST(date_part('quarter', timestamp) AS INTEGER),
+               count(*),
+               min(timestamp),
+               max(timestamp)
+        FROM posts
+        WHERE username IS NOT NULL
+        GROUP BY 1, 2, 3
+        """
+    )
+
+
+def downgrade():
+    op.drop_table('profile_post_stats')
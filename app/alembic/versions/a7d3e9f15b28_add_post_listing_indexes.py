@@ -0,0 +1,41 @@
+"""add post listing indexes
+
+Revision ID: a7d3e9f15b28
+Revises: 5f0d8b6e2c47
+Create Date: 2026-10-18 16:12:51.027734
+
+"""
+import sqlalchemy as sa
+
+from migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e9f15b28'
+down_revision = '5f0d8b6e2c47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently(
+        'ix_posts_username_timestamp_shortcode',
+        'posts',
+        ['username', sa.text('timestamp DESC'), sa.text('shortcode DESC')],
+    )
+    create_index_concurrently(
+        'ix_posts_timestamp_shortcode',
+        'posts',
+        [sa.text('timestamp DESC'), sa.text('shortcode DESC')],
+    )
+
+    # the single column indexes are prefixes of the new ones
+    drop_index_concurrently('ix_posts_username', 'posts')
+    drop_index_concurrently('ix_posts_timestamp', 'posts')
+
+
+def downgrade():
+    create_index_concurrently('ix_posts_timestamp', 'posts', ['timestamp'])
+    create_index_concurrently('ix_posts_username', 'posts', ['username'])
+    drop_index_concurrently('ix_posts_timestamp_shortcode', 'posts')
+    drop_index_concurrently('ix_posts_username_timestamp_shortcode', 'posts')
@@ -0,0 +1,27 @@
+"""add task queue index
+
+Revision ID: b2f64c1d8e93
+Revises: a7d3e9f15b28
+Create Date: 2026-10-18 16:48:20.553190
+
+"""
+from migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2f64c1d8e93'
+down_revision = 'a7d3e9f15b28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_tasks_status_created', 'tasks', ['status', 'created'])
+
+    # the single column status index is a prefix of the new one
+    drop_index_concurrently('ix_tasks_status', 'tasks')
+
+
+def downgrade():
+    create_index_concurrently('ix_tasks_status', 'tasks', ['status'])
+    drop_index_concurrently('ix_tasks_status_created', 'tasks')
@@ -0,0 +1,29 @@
+"""add task lease columns
+
+Revision ID: d41a6b7c2e05
+Revises: b2f64c1d8e93
+Create Date: 2026-10-18 17:31:06.184402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41a6b7c2e05'
+down_revision = 'b2f64c1d8e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('attempts', sa.Integer, server_default=sa.text('0'), nullable=False))
+    op.add_column('tasks', sa.Column('lease_expires', sa.DateTime(timezone=True), nullable=True))
+
+    # tasks left in progress before leases existed are orphans, let them expire right away
+    op.execute("UPDATE tasks SET attempts = 1, lease_expires = now() WHERE status = 'in_progress'")
+
+
+def downgrade():
+    op.drop_column('tasks', 'lease_expires')
+    op.drop_column('tasks', 'attempts')
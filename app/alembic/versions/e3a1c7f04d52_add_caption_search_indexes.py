@@ -0,0 +1,39 @@
+"""add caption search indexes
+
+Revision ID: e3a1c7f04d52
+Revises: 9c2e5f8b3a61
+Create Date: 2026-10-18 14:21:09.318204
+
+"""
+import sqlalchemy as sa
+
+from migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1c7f04d52'
+down_revision = '9c2e5f8b3a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for column in ['caption_hashtags', 'caption_mentions']:
+        # replace the btree indexes, which can't serve containment queries
+        drop_index_concurrently(f'ix_posts_{column}', 'posts', if_exists=True)
+        create_index_concurrently(f'ix_posts_{column}', 'posts', [column], postgresql_using='gin')
+
+    # index the text search vector as an expression, a stored column would rewrite the table under an exclusive lock
+    create_index_concurrently(
+        'ix_posts_caption_tsv',
+        'posts',
+        [sa.text("to_tsvector('simple', coalesce(caption, ''))")],
+        postgresql_using='gin',
+    )
+
+
+def downgrade():
+    drop_index_concurrently('ix_posts_caption_tsv', 'posts')
+    for column in ['caption_hashtags', 'caption_mentions']:
+        drop_index_concurrently(f'ix_posts_{column}', 'posts')
+        create_index_concurrently(f'ix_posts_{column}', 'posts', [column])
@@ -0,0 +1,32 @@
+"""create rate limits table
+
+Revision ID: f8c27e4a9d16
+Revises: d41a6b7c2e05
+Create Date: 2026-10-18 18:40:12.773519
+
+"""
+from alembic import op
+from sqlalchemy import Column, DateTime, Float, Integer, String
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8c27e4a9d16'
+down_revision = 'd41a6b7c2e05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'rate_limits',
+        Column('budget', String, primary_key=True),
+        Column('rate', Float, nullable=False),
+        Column('throttle_count', Integer, nullable=False),
+        Column('last_throttled', DateTime(timezone=True), nullable=True),
+        Column('paused_until', DateTime(timezone=True), nullable=True),
+        Column('updated', DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('rate_limits')
@@ -29,7 +29,9 @@ class PostListResult(BaseModel):
     posts: List[Post]
     limit: int
     offset: int
-    count: int
+    count: Optional[int] = None  # total number of posts, unless counting is skipped
+    next_cursor: Optional[str] = None  # cursor of the page of older posts
+    previous_cursor: Optional[str] = None  # cursor of the page of newer posts
 
 
 class PostCreationFromShortcode(BaseModel):
@@ -9,6 +9,7 @@ class Profile(BaseModel):
     username: str
     display_name: str
     image_filename: str
+    last_synced: Optional[datetime] = None
 
 
 class BaseStats(BaseModel):
@@ -34,7 +35,7 @@ class ProfileListResult(BaseModel):
     data: List[Profile]
     limit: int
     offset: int
-    count: int
+    count: Optional[int] = None
 
 
 class ProfileUpdates(BaseModel):
@@ -0,0 +1,13 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class RateLimit(BaseModel):
+    budget: str
+    rate: float
+    throttle_count: int
+    last_throttled: Optional[datetime] = None
+    paused_until: Optional[datetime] = None
+    updated: Optional[datetime] = None
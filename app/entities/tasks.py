@@ -17,6 +17,8 @@ class BaseTask(BaseModel):
     post_count: Optional[int] = None
     time_range_start: Optional[datetime] = None
     time_range_end: Optional[datetime] = None
+    attempts: Optional[int] = None
+    lease_expires: Optional[datetime] = None
 
 class Task(BaseTask):
     username: Optional[str]
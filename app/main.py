@@ -1,18 +1,18 @@
+import asyncio
 import logging
 import os
+import re
 from datetime import datetime
 from http import HTTPStatus
 from pathlib import Path
 from typing import List, Optional
 
-import aiofiles
 import aiohttp
 import databases
-from fastapi import FastAPI, BackgroundTasks, Request
-from fastapi.responses import Response, FileResponse
+from fastapi import FastAPI, BackgroundTasks, Query, Request
+from fastapi.responses import Response
 from fastapi.websockets import WebSocket, WebSocketDisconnect
 
-from entities.enums import TaskStatus
 from entities.posts import (
     Post,
     PostListResult,
@@ -26,38 +26,105 @@ from entities.profiles import (
     ProfileUpdates,
     ProfileStats,
 )
+from entities.rate_limits import RateLimit
 from entities.tasks import TaskCreateRequest, TaskListResponse
+from responses import (
+    IMMUTABLE_CACHE_CONTROL,
+    REVALIDATE_CACHE_CONTROL,
+    file_response,
+    get_precompressed_variants,
+)
 from services import schema
-from services.exceptions import PostNotFound
+from services.derivative import FORMATS as DERIVATIVE_FORMATS, DerivativeService
+from services.exceptions import InvalidCursor, PostNotFound, ProfileNotFound
 from services.post import PostService
 from services.profile import ProfileService
 from services.task import TaskExecutor
-from services.crud import TaskCRUDService, ProfileCRUDService
+from services.crud import TaskCRUDService, ProfileCRUDService, RateLimitCRUDService
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
+# matches the names of bundles built with output hashing, e.g. main.3f2a8b1c9d0e4f56.js
+HASHED_BUNDLE_PATTERN = re.compile(r"\.[0-9a-f]{16,}\.(js|css)$")
+
+# media dirs whose files are replaced under the same name, e.g. when a profile is created again
+MUTABLE_MEDIA_DIRS = ["profile_images"]
+
+# if tasks are run in the web server, disable when running workers with python -m services.worker
+EMBEDDED_EXECUTOR = os.getenv("EMBEDDED_EXECUTOR", "true").lower() in ["1", "true", "yes"]
+
 app = FastAPI()
 database = databases.Database(schema.database_url)
 http_session = aiohttp.ClientSession()
 
+# the embedded task executor and the event telling it to look for tasks again, created on first use
+executor_task: Optional[asyncio.Task] = None
+executor_wakeup: Optional[asyncio.Event] = None
+
+# keeps the known shortcode filter of the process current
+known_shortcodes_task: Optional[asyncio.Task] = None
+
+
+async def run_executor(wakeup: asyncio.Event):
+    """Run tasks until there are none left, and none were created in the meantime."""
+
+    executor = TaskExecutor(database, http_session)
+    while True:
+        wakeup.clear()
+        try:
+            await executor.run_tasks()
+        except Exception as e:
+            logger.error(f"Task executor failed: {e}", exc_info=True)
+            return
+        if not wakeup.is_set():
+            return
+
+
+def start_executor():
+    """Start the embedded task executor, or wake it up if it is running already."""
+
+    global executor_task, executor_wakeup
+
+    if executor_task and not executor_task.done():
+        executor_wakeup.set()
+        return
+    executor_wakeup = asyncio.Event()
+    executor_task = asyncio.ensure_future(run_executor(executor_wakeup))
+
 
 @app.on_event("startup")
 async def startup():
+    global known_shortcodes_task
+
     await database.connect()
+    known_shortcodes_task = asyncio.ensure_future(PostService(database, http_session).track_known_shortcodes())
+
+    # pick up tasks left by a previous run, the executor returns orphaned ones to the queue first
+    if EMBEDDED_EXECUTOR:
+        start_executor()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    if executor_task:
+        executor_task.cancel()
+    if known_shortcodes_task:
+        known_shortcodes_task.cancel()
     await database.disconnect()
     await http_session.close()
 
 
 @app.get("/api/profiles/", response_model=ProfileListResult)
 async def list_profiles(
-    search: Optional[str] = None, offset: Optional[int] = 0, limit: Optional[int] = 100
+    search: Optional[str] = None,
+    offset: Optional[int] = 0,
+    limit: Optional[int] = 100,
+    with_count: bool = True,
 ):
-    return await ProfileCRUDService(database, http_session).list(search, offset, limit)
+    return await ProfileCRUDService(database, http_session).list(
+        search, offset, limit, with_count=with_count
+    )
 
 
 @app.get("/api/profiles/{username:str}/", response_model=ProfileWithDetail)
@@ -79,9 +146,11 @@ async def delete_profile(username: str):
 
 
 @app.get("/api/stats/", response_model=List[ProfileStats])
-async def get_profile_statistics(username: Optional[str] = None):
+async def get_profile_statistics(
+    username: Optional[str] = None, usernames: Optional[List[str]] = Query(None)
+):
     stats = await ProfileCRUDService(database, http_session).get_stats(
-        username=username
+        username=username, usernames=usernames
     )
     return list(stats.values())
 
@@ -93,10 +162,27 @@ async def list_posts(
     username: Optional[str] = None,
     start_time: Optional[datetime] = None,
     end_time: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    with_count: bool = True,
+    search: Optional[str] = None,
+    hashtags: Optional[List[str]] = Query(None),
+    mentions: Optional[List[str]] = Query(None),
 ):
-    return await PostService(database, http_session).list(
-        offset, limit, username, start_time, end_time
-    )
+    try:
+        return await PostService(database, http_session).list(
+            offset,
+            limit,
+            username,
+            start_time,
+            end_time,
+            cursor=cursor,
+            with_count=with_count,
+            search=search,
+            hashtags=hashtags,
+            mentions=mentions,
+        )
+    except InvalidCursor:
+        return Response(status_code=HTTPStatus.BAD_REQUEST)
 
 
 @app.get("/api/posts/{shortcode:str}/", response_model=Post)
@@ -131,6 +217,13 @@ def create_post_from_saved(
     return Response(status_code=HTTPStatus.ACCEPTED)
 
 
+@app.post("/api/posts/from_failed_downloads/")
+def create_post_from_failed_downloads(background_tasks: BackgroundTasks):
+    service = PostService(database, http_session)
+    background_tasks.add_task(service.create_from_failed_downloads)
+    return Response(status_code=HTTPStatus.ACCEPTED)
+
+
 @app.patch("/api/posts/{shortcode:str}/")
 async def update_post(shortcode: str, request: PostUpdateRequest):
     try:
@@ -139,6 +232,8 @@ async def update_post(shortcode: str, request: PostUpdateRequest):
         )
     except PostNotFound:
         return Response(status_code=HTTPStatus.NOT_FOUND)
+    except ProfileNotFound:
+        return Response(status_code=HTTPStatus.BAD_REQUEST)
 
 
 @app.delete("/api/posts/{shortcode:str}/")
@@ -152,19 +247,12 @@ async def delete_post_item(shortcode: str, index: int):
 
 
 @app.post("/api/tasks/")
-async def create_tasks(request: TaskCreateRequest, background_tasks: BackgroundTasks):
-    # get non-terminal tasks
-    service = TaskCRUDService(database, http_session)
-    non_terminal_tasks = await service.list(
-        limit=1, status=[TaskStatus.PENDING, TaskStatus.IN_PROGRESS]
-    )
+async def create_tasks(request: TaskCreateRequest):
+    await TaskCRUDService(database, http_session).create(request)
 
-    # create new tasks
-    await service.create(request)
-
-    # start task executor, but only if there was no non-terminal tasks before task creation
-    if non_terminal_tasks.count == 0:
-        background_tasks.add_task(TaskExecutor(database, http_session).run_tasks)
+    # run the new tasks, along with any pending ones, in the running executor if there is one
+    if EMBEDDED_EXECUTOR:
+        start_executor()
     return Response(status_code=HTTPStatus.CREATED)
 
 
@@ -179,38 +267,45 @@ async def list_tasks(
     )
 
 
+@app.get("/api/rate_limits/", response_model=List[RateLimit])
+async def list_rate_limits():
+    return await RateLimitCRUDService(database, http_session).list()
+
+
 @app.get("/media/{path:path}")
 async def get_media(path: str, request: Request):
     path = Path("/media").joinpath(path)
-    if not path.exists():
+    if not path.is_file():
         return Response(status_code=HTTPStatus.NOT_FOUND)
-    if range_header := request.headers.get("Range"):
-        size = path.stat().st_size
+    return file_response(request, path, media_cache_control(path))
 
-        try:
-            start, end = range_header.strip("bytes=").split("-")
-            start = int(start)
-            end = size - 1 if end == "" else int(end)
-            chunk_size = end - start + 1
-            if chunk_size <= 0:
-                raise ValueError
-        except ValueError:
-            return Response(status_code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
-
-        async with aiofiles.open(path, mode="rb") as file:
-            await file.seek(start)
-            chunk = await file.read(chunk_size)
-            return Response(
-                chunk,
-                status_code=HTTPStatus.PARTIAL_CONTENT,
-                headers={
-                    "Accept-Ranges": "bytes",
-                    "Content-Range": f"bytes {start}-{end}/{size}",
-                    "Content-Length": str(chunk_size),
-                },
-            )
-    else:
-        return FileResponse(path)
+
+def media_cache_control(path: Path) -> str:
+    """Get the cache policy of a media file or its derivatives.
+
+    :param path: path of the media file
+    :return: the cache control header value
+    """
+
+    if path.relative_to("/media").parts[0] in MUTABLE_MEDIA_DIRS:
+        return REVALIDATE_CACHE_CONTROL
+    return IMMUTABLE_CACHE_CONTROL
+
+
+@app.get("/derivatives/{path:path}")
+async def get_derivative(
+    path: str, request: Request, width: int = 320, format: str = "webp"
+):
+    path = Path("/media").joinpath(path)
+    if (
+        format not in DERIVATIVE_FORMATS
+        or path.suffix.lower() not in [".jpg", ".jpeg", ".png", ".webp"]
+        or not path.is_file()
+    ):
+        return Response(status_code=HTTPStatus.NOT_FOUND)
+    cache_control = media_cache_control(path)
+    path = await DerivativeService(database, http_session).get(path, width, format)
+    return file_response(request, path, cache_control)
 
 
 @app.websocket("/web_socket/posts/")
@@ -243,9 +338,18 @@ async def posts(web_socket: WebSocket):
 
 
 @app.get("/{path:path}")
-async def web(path: str):
+async def web(path: str, request: Request):
     path = Path(path)
     if len(path.parts) == 1 and path.suffix in [".html", ".css", ".js"]:
-        return FileResponse(Path("/web/").joinpath(path.parts[-1]))
+        path = Path("/web/").joinpath(path.parts[-1])
+    else:
+        path = Path("/web/index.html")
+    if get_precompressed_variants(path) is None:
+        return Response(status_code=HTTPStatus.NOT_FOUND)
+
+    # bundles with a content hash in their names can be cached forever, everything else has to be revalidated
+    if HASHED_BUNDLE_PATTERN.search(path.name):
+        cache_control = IMMUTABLE_CACHE_CONTROL
     else:
-        return FileResponse(Path("/web/index.html"))
+        cache_control = REVALIDATE_CACHE_CONTROL
+    return file_response(request, path, cache_control, precompressed=True)
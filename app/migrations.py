@@ -0,0 +1,29 @@
+from alembic import op
+
+
+def create_index_concurrently(index_name: str, table_name: str, columns: list, **kwargs):
+    """Create an index in a migration without blocking writes to the table.
+
+    Postgres can't build indexes concurrently in a transaction, so the index is built outside of the migration's
+    transaction, which is committed first.
+
+    :param index_name: name of the index
+    :param table_name: table to create the index on
+    :param columns: columns or expressions to index
+    :param kwargs: further arguments of op.create_index
+    """
+
+    with op.get_context().autocommit_block():
+        op.create_index(index_name, table_name, columns, postgresql_concurrently=True, **kwargs)
+
+
+def drop_index_concurrently(index_name: str, table_name: str, **kwargs):
+    """Drop an index in a migration without blocking access to the table, see create_index_concurrently.
+
+    :param index_name: name of the index
+    :param table_name: table the index is on
+    :param kwargs: further arguments of op.drop_index
+    """
+
+    with op.get_context().autocommit_block():
+        op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, **kwargs)
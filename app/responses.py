@@ -0,0 +1,388 @@
+import asyncio
+import gzip
+import logging
+import mimetypes
+import os
+import stat
+import sys
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import aiofiles
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# size of the chunks files are streamed to clients with
+CHUNK_SIZE = 256 * 1024
+
+# cache policy of files whose content never changes for a given name, e.g. post media and hashed bundles
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# cache policy of files that have to be revalidated before every use, e.g. index.html and profile images
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# content encodings of precompressed files in order of preference, and the suffixes of their filenames
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# types of files worth precompressing
+COMPRESSIBLE_SUFFIXES = ['.html', '.css', '.js', '.json', '.svg', '.txt']
+
+# paths and stat results of files and their precompressed variants by content encoding, None for the file itself,
+# looked up on first use, static files are only replaced on deploy, which restarts the server
+_precompressed: Dict[Path, Dict[Optional[str], Tuple[Path, os.stat_result]]] = {}
+
+
+def parse_range_header(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse the byte ranges of a Range header.
+
+    Overlapping and adjacent ranges are merged, and ranges reaching beyond the end of the file are truncated.
+
+    :param header: value of the Range header, e.g. "bytes=0-499", "bytes=-500" or "bytes=0-0,-1"
+    :param size: size of the requested file
+    :return: inclusive start and end offsets of the ranges, empty if none of them is satisfiable,
+        or None if the header is malformed and should be ignored
+    """
+
+    unit, _, range_set = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    try:
+        for range_spec in range_set.split(','):
+            first, separator, last = range_spec.strip().partition('-')
+            if not separator:
+                return None
+            if first == '':
+                # suffix range, i.e. the last n bytes of the file
+                length = int(last)
+                if length < 0:
+                    return None
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+            else:
+                start, end = int(first), int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                if start < size:
+                    ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    except ValueError:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(Response):
+    """Partial content response streaming one or more byte ranges of a file.
+
+    A single range is sent as is, multiple ranges as a multipart/byteranges body. The ranges are sent with
+    sendfile through the zero copy ASGI extension when the server supports it, and read in chunks otherwise,
+    so memory usage does not depend on the size of the ranges.
+    """
+
+    def __init__(self, path: Path, ranges: List[Tuple[int, int]], size: int, headers: Optional[dict] = None):
+        self.path = path
+        self.status_code = 206
+        self.media_type = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+        self.background = None
+
+        # build the parts of the body, i.e. the preamble and the range of each part
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.parts = [(b'', start, end)]
+            self.epilogue = b''
+            headers = {**(headers or {}), 'Content-Range': f'bytes {start}-{end}/{size}'}
+        else:
+            boundary = uuid.uuid4().hex
+            self.parts = [
+                (
+                    f'--{boundary}\r\nContent-Type: {self.media_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode('latin-1'),
+                    start,
+                    end,
+                )
+                for start, end in ranges
+            ]
+            self.epilogue = f'--{boundary}--\r\n'.encode('latin-1')
+            self.media_type = f'multipart/byteranges; boundary={boundary}'
+        content_length = sum(len(preamble) + end - start + 1 for preamble, start, end in self.parts) + \
+            (len(self.epilogue) + 2 * (len(self.parts) - 1) + 2 if self.epilogue else 0)
+
+        headers = {**(headers or {}), 'Accept-Ranges': 'bytes', 'Content-Length': str(content_length)}
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as file:
+                for index, (preamble, start, end) in enumerate(self.parts):
+                    await self._send_preamble(send, index, preamble)
+                    await send({
+                        'type': 'http.response.zerocopysend',
+                        'file': file,
+                        'offset': start,
+                        'count': end - start + 1,
+                        'more_body': True,
+                    })
+        else:
+            async with aiofiles.open(self.path, 'rb') as file:
+                for index, (preamble, start, end) in enumerate(self.parts):
+                    await self._send_preamble(send, index, preamble)
+                    await file.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = await file.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise RuntimeError(f'{self.path} is shorter than expected.')
+                        remaining -= len(chunk)
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        epilogue = b'\r\n' + self.epilogue if self.epilogue else b''
+        await send({'type': 'http.response.body', 'body': epilogue, 'more_body': False})
+
+    @staticmethod
+    async def _send_preamble(send: Send, index: int, preamble: bytes):
+        """Send the delimiter and headers of a part of a multipart body.
+
+        :param send: the ASGI send callable
+        :param index: index of the part
+        :param preamble: the delimiter and headers of the part
+        """
+
+        if not preamble:
+            return
+        body = preamble if index == 0 else b'\r\n' + preamble
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+
+def get_validators(stat_result: os.stat_result) -> Tuple[str, str]:
+    """Build the validators of a file.
+
+    :param stat_result: stat result of the file
+    :return: the ETag and Last-Modified header values
+    """
+
+    etag = f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    return etag, last_modified
+
+
+def _match_etag(header: str, etag: str, weak: bool) -> bool:
+    """Check if an ETag matches any of the ETags in a header.
+
+    :param header: value of a If-None-Match or If-Range header
+    :param etag: the current ETag
+    :param weak: if weak comparison should be used
+    :return: if there is a match
+    """
+
+    if header.strip() == '*':
+        return True
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if weak and candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _is_modified_since(header: str, mtime: float) -> bool:
+    """Check if a file is modified since the date in a header.
+
+    :param header: value of a If-Modified-Since or If-Range header
+    :param mtime: modification time of the file
+    :return: if the file is modified since, True if the date is invalid
+    """
+
+    try:
+        return int(mtime) > parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return True
+
+
+def is_not_modified(request_headers: Mapping[str, str], etag: str, mtime: float) -> bool:
+    """Check if the cached copy of the client is still fresh.
+
+    :param request_headers: headers of the request
+    :param etag: the current ETag of the file
+    :param mtime: modification time of the file
+    :return: if a 304 response should be sent
+    """
+
+    if if_none_match := request_headers.get('If-None-Match'):
+        return _match_etag(if_none_match, etag, weak=True)
+    if if_modified_since := request_headers.get('If-Modified-Since'):
+        return not _is_modified_since(if_modified_since, mtime)
+    return False
+
+
+def compress_file(path: Path, encodings: List[str]):
+    """Write precompressed variants of a file next to it.
+
+    :param path: the file to compress
+    :param encodings: content encodings to write variants for
+    """
+
+    data = path.read_bytes()
+    for encoding in encodings:
+        if encoding == 'gzip':
+            compressed = gzip.compress(data, compresslevel=9)
+        elif encoding == 'br' and brotli:
+            compressed = brotli.compress(data, quality=11)
+        else:
+            continue
+        variant_path = path.with_name(path.name + ENCODINGS[encoding])
+        partial_path = variant_path.with_name(f'.{variant_path.name}.part')
+        partial_path.write_bytes(compressed)
+        os.replace(partial_path, variant_path)
+
+
+def get_precompressed_variants(path: Path) -> Optional[Dict[Optional[str], Tuple[Path, os.stat_result]]]:
+    """Get a file and its precompressed variants.
+
+    The lookup, stat results included, is cached, so serving a file doesn't touch the file system until it is
+    opened. Missing variants are generated in the background, and served once they are ready.
+
+    :param path: the file to get variants of
+    :return: paths and stat results of the file (None) and its variants by content encoding, or None if the file
+        doesn't exist
+    """
+
+    if (variants := _precompressed.get(path)) is not None:
+        return variants
+
+    variants = {}
+    for encoding, variant_path in [(None, path)] + [(encoding, path.with_name(path.name + suffix))
+                                                    for encoding, suffix in ENCODINGS.items()]:
+        try:
+            stat_result = variant_path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if stat.S_ISREG(stat_result.st_mode):
+            variants[encoding] = (variant_path, stat_result)
+    if None not in variants:
+        return None
+    _precompressed[path] = variants
+
+    missing = [encoding for encoding in ENCODINGS if encoding not in variants and (encoding != 'br' or brotli)]
+    if missing and path.suffix in COMPRESSIBLE_SUFFIXES:
+        def on_done(future: asyncio.Future):
+            if exception := future.exception():
+                logger.debug(f'Unable to precompress {path}: {exception}')
+            else:
+                _precompressed.pop(path, None)
+
+        future = asyncio.get_running_loop().run_in_executor(None, compress_file, path, missing)
+        future.add_done_callback(on_done)
+    return variants
+
+
+def select_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """Select the preferred content encoding acceptable to the client.
+
+    :param accept_encoding: value of the Accept-Encoding header
+    :param encodings: available content encodings, in order of preference
+    :return: the selected content encoding, or None if the file should be sent as is
+    """
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, parameters = item.strip().partition(';')
+        try:
+            quality = float(parameters.strip()[2:]) if parameters.strip().startswith('q=') else 1
+        except ValueError:
+            quality = 0
+        qualities[coding.strip().lower()] = quality
+
+    candidates = [
+        encoding for encoding in encodings
+        if qualities.get(encoding, qualities.get('*', 0)) > 0
+    ]
+    return max(candidates, key=lambda encoding: qualities.get(encoding, qualities.get('*', 0)), default=None)
+
+
+def file_response(request: Request, path: Path, cache_control: str, precompressed: bool = False) -> Response:
+    """Respond with a file, honoring conditional and range requests.
+
+    :param request: the request
+    :param path: path of the file, which has to exist, and has to have been looked up with
+        get_precompressed_variants if precompressed
+    :param cache_control: value of the Cache-Control header
+    :param precompressed: if a precompressed variant of the file should be sent, if the client accepts one
+    :return: the response
+    """
+
+    headers = {'Cache-Control': cache_control}
+
+    # send a precompressed variant, ranges are not supported for those
+    encoding, media_type, stat_result = None, None, None
+    if precompressed:
+        headers['Vary'] = 'Accept-Encoding'
+        variants = get_precompressed_variants(path)
+        encodings = [encoding for encoding in variants if encoding]
+        encoding = select_encoding(request.headers.get('Accept-Encoding', ''), encodings)
+        media_type = mimetypes.guess_type(str(path))[0]
+        path, stat_result = variants[encoding]
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    else:
+        media_type = None
+        headers['Accept-Ranges'] = 'bytes'
+
+    stat_result = stat_result or path.stat()
+    etag, last_modified = get_validators(stat_result)
+    headers['ETag'] = etag
+    headers['Last-Modified'] = last_modified
+
+    if is_not_modified(request.headers, etag, stat_result.st_mtime):
+        headers.pop('Content-Encoding', None)
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    if encoding:
+        return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
+
+    # a range is only sent if the client's copy is still current, otherwise the whole file is sent
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and if_range:
+        if if_range.strip().startswith(('"', 'W/')):
+            is_current = _match_etag(if_range, etag, weak=False)
+        else:
+            is_current = not _is_modified_since(if_range, stat_result.st_mtime)
+        range_header = range_header if is_current else None
+    if range_header:
+        ranges = parse_range_header(range_header, stat_result.st_size)
+        if ranges == []:
+            return Response(
+                status_code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'Content-Range': f'bytes */{stat_result.st_size}'},
+            )
+        if ranges:
+            return RangeFileResponse(path, ranges, stat_result.st_size, headers)
+
+    return FileResponse(path, headers=headers, stat_result=stat_result)
+
+
+if __name__ == '__main__':
+    # precompress files in a directory at build time, e.g. python responses.py /web
+    for file_path in Path(sys.argv[1]).glob('**/*'):
+        if file_path.is_file() and file_path.suffix in COMPRESSIBLE_SUFFIXES:
+            compress_file(file_path, list(ENCODINGS))
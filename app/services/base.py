@@ -1,3 +1,6 @@
+import asyncio
+import hashlib
+import json
 import logging
 import mimetypes
 import os
@@ -5,18 +8,81 @@ import pathlib
 import shutil
 from datetime import datetime
 from functools import cached_property
+from http import HTTPStatus
 from pathlib import Path
 from typing import Optional
 
+import aiofiles
 import aiohttp
 import instaloader
-import requests
 from databases import Database
 
+from services.rate_limit import RateController, get_bucket
+
 logger = logging.getLogger(__name__)
 
+# size of the chunks media downloads are streamed to disk with
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# no overall deadline for media downloads, large videos can take a while, but give up on stalled connections
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+
+def _fsync_directory(path: Path):
+    """Flush directory entries, e.g. a rename, to disk.
+
+    :param path: the directory to flush
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _hash_file(path: Path) -> 'hashlib._Hash':
+    """Compute the sha256 hash of a file.
+
+    :param path: the file to hash
+    :return: the hash object, which can be updated further
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest
+
+
+def _read_partial_info(path: Path) -> Optional[dict]:
+    """Read what identifies the remote file a partial download belongs to.
+
+    :param path: the info file of the partial download
+    :return: validator (etag or last modified) and total length of the remote file, or None if unknown
+    """
+
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _discard_partial(partial_path: Path, partial_info_path: Path):
+    """Delete a partial download and its info, so that the next attempt starts over.
+
+    :param partial_path: the partial file
+    :param partial_info_path: the info file of the partial download
+    """
+
+    partial_path.unlink(missing_ok=True)
+    partial_info_path.unlink(missing_ok=True)
+
 
 class BaseService:
+    # limits the number of media downloads in flight across all services, created on first use
+    _download_semaphore: Optional[asyncio.Semaphore] = None
+
     def __init__(self, database: Database, http_session: aiohttp.ClientSession):
         self.database = database
         self.http_session = http_session
@@ -27,6 +93,7 @@ class BaseService:
         self.profile_images_dir = self.media_dir.joinpath('profile_images')
         self.post_dir = self.media_dir.joinpath('posts')
         self.thumb_images_dir = self.media_dir.joinpath('thumb_images')
+        self.blobs_dir = self.media_dir.joinpath('blobs')
 
         # Environment Variables
         self.instagram_username = os.getenv('INSTAGRAM_USERNAME')
@@ -38,10 +105,13 @@ class BaseService:
             self.group_id = int(os.getenv('GROUP_ID'))
         except ValueError:
             self.group_id = None
+        self.max_concurrent_downloads = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 8))
+        self.max_concurrent_post_downloads = int(os.getenv('MAX_CONCURRENT_POST_DOWNLOADS', 4))
+        self.content_addressed_storage = os.getenv('CONTENT_ADDRESSED_STORAGE', '').lower() in ['1', 'true', 'yes']
 
     @cached_property
     def instaloader(self):
-        instance = instaloader.Instaloader()
+        instance = instaloader.Instaloader(rate_controller=RateController)
         if username := self.instagram_username:
             path = str(self.sessions_dir.joinpath(f'{username}.session'))
             try:
@@ -70,11 +140,19 @@ class BaseService:
         if self.user_id or self.group_id:
             shutil.chown(path, self.user_id, self.group_id)
 
-    def _download(
+    async def _download(
         self, url: str, working_dir: Path, filename: str, timestamp: Optional[datetime] = None
     ) -> pathlib.Path:
         """Download a file from url to working dir with filename and optionally an access and update time.
 
+        The response body is streamed in chunks to a hidden partial file, which is synced and atomically renamed to
+        the destination path once complete, so a crash never leaves a truncated file behind. A partial file left by
+        an interrupted download is resumed with a range request, provided the remote file has the same validator
+        (etag or last modified) and length as when the download started.
+
+        With content addressed storage enabled, the file is hashed while streaming and hard linked to a blob named
+        after its hash, so identical media downloaded more than once is stored only once.
+
         :param url: the url to retrieve the file
         :param working_dir: the dir to save the file
         :param filename: filename the file should be saved as (without extension)
@@ -82,31 +160,144 @@ class BaseService:
         :return file_path: the path of the saved image or video
         """
 
-        # retrieve file
-        response = requests.get(url)
-
         # prepare working dir
         working_dir.mkdir(parents=True, exist_ok=True)
         self._set_file_ownership(working_dir)
 
-        # prepare destination path
-        extension = mimetypes.guess_extension(response.headers['content-type'])
-        file_path = working_dir.joinpath(filename).with_suffix(extension)
+        # resume from the end of the partial file, if there is one, but only if the remote file is still the same
+        partial_path = working_dir.joinpath(f'.{filename}.part')
+        partial_info_path = working_dir.joinpath(f'.{filename}.part.json')
+        if partial_path.exists() and partial_path.stat().st_nlink > 1:
+            # a partial file linked to a blob holds complete content, writing to it would change the blob
+            _discard_partial(partial_path, partial_info_path)
+        partial_info = _read_partial_info(partial_info_path) if partial_path.exists() else None
+        offset = partial_path.stat().st_size if partial_info else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+            if partial_info['validator']:
+                headers['If-Range'] = partial_info['validator']
+        loop = asyncio.get_running_loop()
+
+        await get_bucket('media').acquire_async()
+        if BaseService._download_semaphore is None:
+            BaseService._download_semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        async with BaseService._download_semaphore, \
+                self.http_session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+            # the partial file does not match the remote file, discard it so that the next attempt starts over
+            if response.status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE:
+                _discard_partial(partial_path, partial_info_path)
+            response.raise_for_status()
+
+            # prepare destination path
+            extension = mimetypes.guess_extension(response.content_type)
+            file_path = working_dir.joinpath(filename).with_suffix(extension)
+
+            # append to the partial file only if the server honored the range, otherwise start from scratch
+            content_range = response.headers.get('Content-Range', '')
+            is_resumed = response.status == HTTPStatus.PARTIAL_CONTENT and content_range.startswith(f'bytes {offset}-')
+            length = content_range.rsplit('/', 1)[-1] if content_range else str(response.content_length)
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            if is_resumed and (
+                length != partial_info['length']
+                or validator and partial_info['validator'] and validator != partial_info['validator']
+            ):
+                # the remote file changed, e.g. a different rendition behind a re-signed url, the range doesn't fit
+                _discard_partial(partial_path, partial_info_path)
+                raise aiohttp.ClientPayloadError(f'{file_path.name} changed since its download was interrupted')
+            if is_resumed:
+                logger.debug(f'Resuming download of {file_path.name} from byte {offset}.')
+            else:
+                partial_info_path.write_text(json.dumps({'validator': validator, 'length': length}))
+
+            # the hash of a resumed download has to include the data downloaded previously
+            if not self.content_addressed_storage:
+                digest = None
+            elif is_resumed:
+                digest = await loop.run_in_executor(None, _hash_file, partial_path)
+            else:
+                digest = hashlib.sha256()
 
-        # save file data
-        with open(file_path, 'wb') as file:
-            file.write(response.content)
+            # stream file data and make sure it is on disk
+            async with aiofiles.open(partial_path, 'ab' if is_resumed else 'wb') as file:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await file.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                await file.flush()
+                await loop.run_in_executor(None, os.fsync, file.fileno())
+
+        # replace the downloaded data with a link to an existing blob with the same content, if there is one
+        is_deduplicated = digest is not None and self._link_blob(partial_path, digest.hexdigest())
 
         # set file access and update time
-        if timestamp:
-            os.utime(file_path, (timestamp.timestamp(), timestamp.timestamp()))
+        if timestamp and not is_deduplicated:
+            os.utime(partial_path, (timestamp.timestamp(), timestamp.timestamp()))
 
         # set file ownership
-        self._set_file_ownership(file_path)
+        self._set_file_ownership(partial_path)
+
+        # move the complete file into place, unless it is in place already, i.e. linked to the same blob, as renaming
+        # a link onto another link of the same file does nothing
+        replaced_blob_path = await self._find_sole_blob(file_path) if self.content_addressed_storage else None
+        if file_path.exists() and file_path.samefile(partial_path):
+            partial_path.unlink()
+        else:
+            os.replace(partial_path, file_path)
+        partial_info_path.unlink(missing_ok=True)
+        _fsync_directory(working_dir)
+
+        # delete the blob of a replaced file if nothing links to it anymore
+        if replaced_blob_path and replaced_blob_path.stat().st_nlink == 1:
+            replaced_blob_path.unlink()
 
         return file_path
 
-    def delete_file(self, working_dir: Path, *path_components):
+    def _link_blob(self, path: Path, digest: str) -> bool:
+        """Link a downloaded file with the blob of its content.
+
+        :param path: the downloaded file
+        :param digest: sha256 hex digest of the file content
+        :return: if the file is replaced by a link to a blob that already existed
+        """
+
+        blob_path = self.blobs_dir.joinpath(digest[:2], digest)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob_path)
+            return False
+        except FileExistsError:
+            link_path = path.with_name(f'{path.name}.link')
+            os.link(blob_path, link_path)
+            os.replace(link_path, path)
+            return True
+
+    def _collect_blobs(self):
+        """Delete blobs no longer linked to by any media file."""
+
+        for blob_path in self.blobs_dir.glob('*/*'):
+            if blob_path.stat().st_nlink == 1:
+                blob_path.unlink()
+
+    async def _find_sole_blob(self, path: Path) -> Optional[Path]:
+        """Find the blob of a file, if the file is the only one linked to it.
+
+        :param path: the file
+        :return: path of the blob, or None if there is none, or other files are linked to it as well
+        """
+
+        if not path.exists() or path.stat().st_nlink != 2:
+            return None
+        digest = (await asyncio.get_running_loop().run_in_executor(None, _hash_file, path)).hexdigest()
+        blob_path = self.blobs_dir.joinpath(digest[:2], digest)
+        return blob_path if blob_path.exists() and blob_path.samefile(path) else None
+
+    async def delete_file(self, working_dir: Path, *path_components):
         path = working_dir.joinpath(*path_components)
         self._set_file_ownership(path)
+
+        # delete the blob as well if this is the last file linked to it
+        blob_path = await self._find_sole_blob(path) if self.content_addressed_storage else None
         path.unlink()
+        if blob_path:
+            blob_path.unlink()
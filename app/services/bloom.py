@@ -0,0 +1,42 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """A set of strings that may report false positives at a bounded rate, but never false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        :param capacity: number of items the error rate holds for
+        :param error_rate: probability of a false positive once the filter holds its capacity
+        """
+
+        self.capacity = max(capacity, 1)
+        self.bit_count = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        """Get the bit positions of an item, derived from two halves of one digest.
+
+        :param item: the item
+        :return: the bit positions
+        """
+
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((first + i * second) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, item: str):
+        """Add an item to the filter.
+
+        :param item: the item
+        """
+
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
@@ -1,2 +1,3 @@
 from .profile import ProfileCRUDService
+from .rate_limit import RateLimitCRUDService
 from .task import TaskCRUDService
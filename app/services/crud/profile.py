@@ -1,7 +1,7 @@
 import asyncio
 from collections import defaultdict
 from datetime import timezone
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 import sqlalchemy as sa
 
@@ -20,44 +20,80 @@ from .task import TaskCRUDService
 
 class ProfileCRUDService(BaseService):
     async def list(
-        self, search: Optional[str] = None, offset: int = 0, limit: int = 100
+        self,
+        search: Optional[str] = None,
+        offset: int = 0,
+        limit: int = 100,
+        with_count: bool = True,
     ) -> ProfileListResult:
-        """List profiles."""
+        """List profiles.
+
+        Searches match substrings and similar spellings of the username, full name and display name using the
+        trigram indexes, and results are ranked by similarity. Skip the count to cap the results cheaply, e.g. for
+        typeahead.
+        """
 
         # fetch data
-        base_query = schema.profiles.select()
+        columns = [
+            schema.profiles.c.username,
+            schema.profiles.c.display_name,
+            schema.profiles.c.image_filename,
+            schema.profiles.c.last_synced,
+        ]
+        base_query = sa.select(*columns)
         if search:
-            conditions = [
-                schema.profiles.c.username.ilike(f"%{search}%"),
-                schema.profiles.c.full_name.ilike(f"%{search}%"),
-                schema.profiles.c.display_name.ilike(f"%{search}%"),
+            search_columns = [
+                schema.profiles.c.username,
+                schema.profiles.c.full_name,
+                schema.profiles.c.display_name,
             ]
-            base_query = base_query.where(sa.or_(*conditions))
+            conditions = [column.ilike(f"%{search}%") for column in search_columns]
+            conditions.extend(column.op("%")(search) for column in search_columns)
+            similarity = sa.func.greatest(
+                *[sa.func.similarity(column, search) for column in search_columns]
+            )
+            base_query = base_query.add_columns(similarity.label("similarity")).where(
+                sa.or_(*conditions)
+            )
         base_query = base_query.cte("base_query")
-        count_query = (
-            sa.select(sa.func.count().label("total_count"))
-            .select_from(base_query)
-            .cte("count_query")
-        )
-        query = (
-            sa.select(
-                base_query.c.username,
-                base_query.c.display_name,
-                base_query.c.image_filename,
-                count_query.c.total_count,
+        query_columns = [
+            base_query.c.username,
+            base_query.c.display_name,
+            base_query.c.image_filename,
+            base_query.c.last_synced,
+        ]
+        from_clause = base_query
+        if with_count:
+            count_query = (
+                sa.select(sa.func.count().label("total_count"))
+                .select_from(base_query)
+                .cte("count_query")
             )
-            .select_from(
-                base_query.outerjoin(count_query, onclause=sa.sql.true(), full=True)
+            query_columns.append(count_query.c.total_count)
+            from_clause = base_query.outerjoin(
+                count_query, onclause=sa.sql.true(), full=True
             )
-            .order_by(base_query.c.display_name)
+        order_by = [base_query.c.display_name]
+        if search:
+            order_by.insert(0, base_query.c.similarity.desc())
+        query = (
+            sa.select(*query_columns)
+            .select_from(from_clause)
+            .order_by(*order_by)
             .offset(offset if offset > 0 else None)
             .limit(limit if limit > 0 else None)
         )
         rows = await self.database.fetch_all(query)
 
         # process result
-        total_count = rows[0]["total_count"]
-        profiles = [Profile(**dict(row)) for row in rows] if total_count > 0 else []
+        if with_count:
+            total_count = rows[0]["total_count"]
+            profiles = (
+                [Profile(**dict(row)) for row in rows] if total_count > 0 else []
+            )
+        else:
+            total_count = None
+            profiles = [Profile(**dict(row)) for row in rows]
 
         return ProfileListResult(
             data=profiles, limit=limit, offset=offset, count=total_count
@@ -73,6 +109,7 @@ class ProfileCRUDService(BaseService):
                 schema.profiles.c.display_name,
                 schema.profiles.c.biography,
                 schema.profiles.c.image_filename,
+                schema.profiles.c.last_synced,
             )
             .select_from(schema.profiles)
             .where(schema.profiles.c.username == username)
@@ -93,72 +130,39 @@ class ProfileCRUDService(BaseService):
         return profile
 
     async def get_stats(
-        self, username: Optional[str] = None
+        self, username: Optional[str] = None, usernames: Optional[List[str]] = None
     ) -> Dict[str, ProfileStats]:
-        """Get post stats."""
+        """Get post stats, of all profiles or only of the given ones."""
 
-        # build conditions
+        # build conditions, only the rollup rows of the requested profiles are read
         conditions = []
         if username:
-            conditions.append(schema.profiles.c.username == username)
+            conditions.append(schema.profile_post_stats.c.username == username)
+        if usernames is not None:
+            conditions.append(schema.profile_post_stats.c.username.in_(usernames))
 
-        # build profiles and quarters cte
-        profiles_cte = (
+        # build query and get data, totals are derived from the quarterly rollup
+        statement = (
             sa.select(
-                schema.profiles.c.username,
+                schema.profile_post_stats.c.username,
                 schema.profiles.c.display_name,
-                sa.func.min(schema.posts.c.timestamp).label("first_post_timestamp"),
-                sa.func.max(schema.posts.c.timestamp).label("last_post_timestamp"),
-                sa.func.count().label("total_count"),
+                schema.profile_post_stats.c.year,
+                schema.profile_post_stats.c.quarter,
+                schema.profile_post_stats.c.count,
+                schema.profile_post_stats.c.first_post_timestamp,
+                schema.profile_post_stats.c.last_post_timestamp,
             )
             .select_from(
-                schema.profiles.join(
-                    schema.posts, schema.profiles.c.username == schema.posts.c.username
+                schema.profile_post_stats.join(
+                    schema.profiles,
+                    schema.profiles.c.username == schema.profile_post_stats.c.username,
                 )
             )
             .where(*conditions)
-            .group_by(schema.profiles.c.username)
-            .cte("profiles")
-        )
-        quarters_cte = (
-            sa.select(
-                schema.posts.c.username,
-                sa.func.cast(
-                    sa.func.date_part("year", schema.posts.c.timestamp), sa.INT
-                ).label("year"),
-                sa.func.cast(
-                    sa.func.date_part("quarter", schema.posts.c.timestamp), sa.INT
-                ).label("quarter"),
-                sa.func.count().label("count"),
-            )
-            .select_from(schema.posts)
-            .group_by(
-                schema.posts.c.username,
-                sa.literal_column("year"),
-                sa.literal_column("quarter"),
-            )
-            .cte("quarters")
-        )
-
-        # build query and get data
-        statement = (
-            sa.select(
-                profiles_cte.c.username,
-                profiles_cte.c.display_name,
-                profiles_cte.c.first_post_timestamp,
-                profiles_cte.c.last_post_timestamp,
-                profiles_cte.c.total_count,
-                quarters_cte.c.year,
-                quarters_cte.c.quarter,
-                quarters_cte.c.count,
-            )
-            .select_from(
-                profiles_cte.join(
-                    quarters_cte, quarters_cte.c.username == profiles_cte.c.username
-                )
-            )
             .order_by(
-                profiles_cte.c.display_name, quarters_cte.c.year, quarters_cte.c.quarter
+                schema.profiles.c.display_name,
+                schema.profile_post_stats.c.year,
+                schema.profile_post_stats.c.quarter,
             )
         )
         rows = await self.database.fetch_all(statement)
@@ -167,21 +171,30 @@ class ProfileCRUDService(BaseService):
         profile_stats = {}
         for row in rows:
             username = row["username"]
+            first_post_timestamp = row["first_post_timestamp"].replace(
+                tzinfo=timezone.utc
+            )
+            last_post_timestamp = row["last_post_timestamp"].replace(
+                tzinfo=timezone.utc
+            )
             stats = profile_stats.get(
                 username,
                 ProfileStats(
                     username=username,
                     display_name=row["display_name"],
-                    first_post_timestamp=row["first_post_timestamp"].replace(
-                        tzinfo=timezone.utc
-                    ),
-                    last_post_timestamp=row["last_post_timestamp"].replace(
-                        tzinfo=timezone.utc
-                    ),
-                    total_count=row["total_count"],
+                    first_post_timestamp=first_post_timestamp,
+                    last_post_timestamp=last_post_timestamp,
+                    total_count=0,
                     counts=defaultdict(dict),
                 ),
             )
+            stats.first_post_timestamp = min(
+                stats.first_post_timestamp, first_post_timestamp
+            )
+            stats.last_post_timestamp = max(
+                stats.last_post_timestamp, last_post_timestamp
+            )
+            stats.total_count += row["count"]
             stats.counts[str(row["year"])][f"Q{row['quarter']}"] = row["count"]
             profile_stats[username] = stats
         return profile_stats
@@ -0,0 +1,45 @@
+from typing import List
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from entities.rate_limits import RateLimit
+from services import schema
+from services.rate_limit import DEFAULT_RATES, get_bucket
+from ..base import BaseService
+
+
+class RateLimitCRUDService(BaseService):
+    async def list(self) -> List[RateLimit]:
+        """List the last saved state of each rate limit budget."""
+
+        statement = sa.select(schema.rate_limits).order_by(schema.rate_limits.c.budget)
+        rows = await self.database.fetch_all(statement)
+        return [RateLimit(**dict(row)) for row in rows]
+
+    async def load(self):
+        """Restore the rate limit budgets of the process from their last saved state."""
+
+        for rate_limit in await self.list():
+            if rate_limit.budget in DEFAULT_RATES:
+                get_bucket(rate_limit.budget).set_state(rate_limit)
+
+    async def save(self):
+        """Save the state of the rate limit budgets of the process."""
+
+        values = [get_bucket(budget).get_state(budget).dict() for budget in DEFAULT_RATES]
+        statement = insert(schema.rate_limits).values(values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[schema.rate_limits.c.budget],
+            set_={
+                column: statement.excluded[column]
+                for column in [
+                    "rate",
+                    "throttle_count",
+                    "last_throttled",
+                    "paused_until",
+                    "updated",
+                ]
+            },
+        )
+        await self.database.execute(statement)
@@ -1,4 +1,7 @@
-from datetime import datetime
+import json
+import logging
+import os
+from datetime import datetime, timedelta
 from typing import List, Optional
 from uuid import uuid4
 
@@ -11,8 +14,18 @@ from entities.tasks import Task, TaskCreateRequest, TaskListResponse
 from services import schema
 from ..base import BaseService
 
+logger = logging.getLogger(__name__)
+
+# channel notified when tasks are created, which workers listen on
+TASKS_CHANNEL = "tasks"
+
 
 class TaskCRUDService(BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lease_duration = timedelta(seconds=float(os.getenv("TASK_LEASE_DURATION", 120)))
+        self.max_attempts = int(os.getenv("TASK_MAX_ATTEMPTS", 3))
+
     async def create(self, request: TaskCreateRequest) -> [Task]:
         """Create tasks.
 
@@ -48,6 +61,7 @@ class TaskCRUDService(BaseService):
         values = [task.dict(exclude_unset=True) for task in tasks]
         statement = insert(schema.tasks).values(values).on_conflict_do_nothing()
         await self.database.execute(statement)
+        await self.database.execute(sa.select(sa.func.pg_notify(TASKS_CHANNEL, "")))
         return tasks
 
     async def list(
@@ -100,6 +114,8 @@ class TaskCRUDService(BaseService):
                 base_cte.c.post_count,
                 base_cte.c.time_range_start,
                 base_cte.c.time_range_end,
+                base_cte.c.attempts,
+                base_cte.c.lease_expires,
                 count_cte.c.total_count,
             )
             .select_from(
@@ -126,34 +142,103 @@ class TaskCRUDService(BaseService):
 
         return TaskListResponse(data=tasks, limit=limit, offset=offset, count=count)
 
-    async def get_next(self) -> Optional[Task]:
-        """Get the next task to execute.
+    async def claim_next(self) -> Optional[Task]:
+        """Claim the oldest pending task by setting it in progress, in a single statement.
 
-        :return: next task to execute
+        Pending tasks locked by a concurrent claim are skipped, so executors in several processes never claim the
+        same task. The claim holds a lease on the task, which has to be renewed until the task completes.
+
+        :return: the claimed task, or None if there are no pending tasks
         """
 
-        tasks = await self.list(
-            offset=0, limit=1, status=[TaskStatus.PENDING], is_ascending=True
+        next_task_id = (
+            sa.select(schema.tasks.c.id)
+            .where(schema.tasks.c.status == TaskStatus.PENDING)
+            .order_by(schema.tasks.c.created)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        statement = (
+            sa.update(schema.tasks)
+            .where(schema.tasks.c.id == next_task_id)
+            .values(
+                status=TaskStatus.IN_PROGRESS,
+                started=datetime.utcnow(),
+                attempts=schema.tasks.c.attempts + 1,
+                lease_expires=sa.func.now() + self.lease_duration,
+            )
+            .returning(*schema.tasks.c)
         )
-        return tasks.data[0] if tasks.data else None
+        result = await self.database.fetch_one(statement)
+        return Task(**dict(result)) if result else None
 
-    async def set_in_progress(self, task):
-        """Set task status to in_progress.
+    @staticmethod
+    def _is_leased(task):
+        """Build the condition that a task is still held by the claim it was run with, i.e. it wasn't reaped.
 
-        :param task: the task to update
-        :return: the updated task
+        Updates of a running task are conditioned on it, so an executor that lost its lease stops writing to it.
+
+        :param task: the claimed task
+        :return: the condition
         """
 
-        task.status = TaskStatus.IN_PROGRESS
-        task.started = datetime.utcnow()
+        return sa.and_(
+            schema.tasks.c.id == task.id,
+            schema.tasks.c.status == TaskStatus.IN_PROGRESS,
+            schema.tasks.c.attempts == task.attempts,
+        )
+
+    async def renew_lease(self, task) -> bool:
+        """Extend the lease on an in progress task.
+
+        :param task: the task to renew the lease of
+        :return: if the lease was renewed, false if the task was reaped in the meantime
+        """
 
-        updates = {"status": task.status, "started": task.started}
         statement = (
             sa.update(schema.tasks)
-            .where(schema.tasks.c.id == task.id)
-            .values(**updates)
+            .where(self._is_leased(task))
+            .values(lease_expires=sa.func.now() + self.lease_duration)
+            .returning(schema.tasks.c.lease_expires)
         )
-        await self.database.execute(statement)
+        lease_expires = await self.database.fetch_val(statement)
+        if lease_expires:
+            task.lease_expires = lease_expires
+        return lease_expires is not None
+
+    async def reap_expired(self):
+        """Return in progress tasks whose lease expired to pending, or fail them if they ran out of attempts."""
+
+        is_expired = sa.and_(
+            schema.tasks.c.status == TaskStatus.IN_PROGRESS,
+            schema.tasks.c.lease_expires < sa.func.now(),
+        )
+        async with self.database.transaction():
+            statement = (
+                sa.update(schema.tasks)
+                .where(is_expired, schema.tasks.c.attempts >= self.max_attempts)
+                .values(
+                    status=TaskStatus.FAILED,
+                    completed=datetime.utcnow(),
+                    lease_expires=None,
+                )
+                .returning(schema.tasks.c.id)
+            )
+            failed = await self.database.fetch_all(statement)
+            statement = (
+                sa.update(schema.tasks)
+                .where(is_expired)
+                .values(status=TaskStatus.PENDING, started=None, lease_expires=None)
+                .returning(schema.tasks.c.id)
+            )
+            retried = await self.database.fetch_all(statement)
+
+        if failed:
+            logger.warning(f"Failed {len(failed)} expired task(s) out of attempts.")
+        if retried:
+            logger.warning(f"Returned {len(retried)} expired task(s) to the queue.")
+            await self.database.execute(sa.select(sa.func.pg_notify(TASKS_CHANNEL, "")))
 
     async def set_succeeded(self, task):
         """Set task status to succeeded.
@@ -169,10 +254,12 @@ class TaskCRUDService(BaseService):
             "status": task.status,
             "completed": task.completed,
             "post_count": task.post_count,
+            "lease_expires": None,
+            "checkpoint": None,
         }
         statement = (
             sa.update(schema.tasks)
-            .where(schema.tasks.c.id == task.id)
+            .where(self._is_leased(task))
             .values(**updates)
         )
         await self.database.execute(statement)
@@ -191,10 +278,11 @@ class TaskCRUDService(BaseService):
             "status": task.status,
             "completed": task.completed,
             "post_count": task.post_count,
+            "lease_expires": None,
         }
         statement = (
             sa.update(schema.tasks)
-            .where(schema.tasks.c.id == task.id)
+            .where(self._is_leased(task))
             .values(**updates)
         )
         await self.database.execute(statement)
@@ -208,7 +296,35 @@ class TaskCRUDService(BaseService):
         updates = {"post_count": task.post_count}
         statement = (
             sa.update(schema.tasks)
-            .where(schema.tasks.c.id == task.id)
+            .where(self._is_leased(task))
+            .values(**updates)
+        )
+        await self.database.execute(statement)
+
+    async def get_checkpoint(self, task) -> Optional[dict]:
+        """Get the checkpoint a task can resume from.
+
+        :param task: the task
+        :return: the checkpoint, or None if the task has none
+        """
+
+        statement = sa.select(schema.tasks.c.checkpoint).where(
+            schema.tasks.c.id == task.id
+        )
+        checkpoint = await self.database.fetch_val(statement)
+        return json.loads(checkpoint) if isinstance(checkpoint, str) else checkpoint
+
+    async def set_checkpoint(self, task, checkpoint: dict):
+        """Set task checkpoint, along with the post count at the checkpoint.
+
+        :param task: the task to update
+        :param checkpoint: the checkpoint to resume from
+        """
+
+        updates = {"checkpoint": checkpoint, "post_count": task.post_count}
+        statement = (
+            sa.update(schema.tasks)
+            .where(self._is_leased(task))
             .values(**updates)
         )
         await self.database.execute(statement)
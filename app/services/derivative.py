@@ -0,0 +1,204 @@
+import asyncio
+import fcntl
+import logging
+import os
+import stat
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps
+
+from services.base import BaseService
+
+logger = logging.getLogger(__name__)
+
+# widths derivatives are rendered at, requested widths are rounded up to the next bucket
+WIDTH_BUCKETS = [160, 320, 480, 640, 1080]
+
+# formats derivatives can be encoded as, and their Pillow format names
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+# state shared by all derivative services of the process, created on first use
+_process_pool: Optional[ProcessPoolExecutor] = None
+_cache_entries: Optional['OrderedDict[Path, int]'] = None
+_cache_size = 0
+_cache_added_since_scan = 0
+_cache_lock: Optional[asyncio.Lock] = None
+_renderings: Dict[Path, asyncio.Future] = {}
+
+
+def _render_derivative(source: Path, destination: Path, width: int, image_format: str, quality: int):
+    """Render a resized and re-encoded copy of an image, runs in a worker process.
+
+    :param source: path of the original image
+    :param destination: path to save the derivative to
+    :param width: maximum width of the derivative, images are never enlarged
+    :param image_format: Pillow format name of the derivative
+    :param quality: encoder quality of the derivative
+    """
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width * 4))
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        partial_path = destination.with_name(f'.{destination.name}.part')
+        try:
+            image.save(partial_path, format=image_format, quality=quality)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+    os.replace(partial_path, destination)
+
+
+def _scan_cache(derivatives_dir: Path) -> 'OrderedDict[Path, int]':
+    """List the derivatives in the cache dir.
+
+    :param derivatives_dir: the cache dir
+    :return: sizes of the derivatives, least recently used first
+    """
+
+    paths = [path for path in derivatives_dir.glob('**/*') if path.name[0] != '.']
+    stat_results = {}
+    for path in paths:
+        try:
+            stat_results[path] = path.stat()
+        except FileNotFoundError:
+            continue
+    paths = [path for path, stat_result in stat_results.items() if stat.S_ISREG(stat_result.st_mode)]
+    paths.sort(key=lambda path: stat_results[path].st_atime)
+    return OrderedDict((path, stat_results[path].st_size) for path in paths)
+
+
+def _evict_derivatives(derivatives_dir: Path, max_size: int) -> 'OrderedDict[Path, int]':
+    """Evict least recently used derivatives until the cache dir fits its size.
+
+    The cache dir is shared by the processes of the server, so the dir is scanned rather than trusting the index of
+    the process, and a file lock makes sure only one process evicts at a time.
+
+    :param derivatives_dir: the cache dir
+    :param max_size: maximum total size of the derivatives
+    :return: sizes of the remaining derivatives, least recently used first
+    """
+
+    derivatives_dir.mkdir(parents=True, exist_ok=True)
+    with open(derivatives_dir.joinpath('.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        entries = _scan_cache(derivatives_dir)
+        size = sum(entries.values())
+        while size > max_size and len(entries) > 1:
+            evicted_path, evicted_size = entries.popitem(last=False)
+            evicted_path.unlink(missing_ok=True)
+            size -= evicted_size
+            logger.debug(f'Evicted derivative {evicted_path}.')
+    return entries
+
+
+class DerivativeService(BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.derivatives_dir = Path(os.getenv('DERIVATIVE_CACHE_DIR', '/cache/derivatives'))
+        self.max_cache_size = int(os.getenv('DERIVATIVE_CACHE_SIZE', 1024 ** 3))
+        self.quality = int(os.getenv('DERIVATIVE_QUALITY', 80))
+        self.max_workers = int(os.getenv('DERIVATIVE_WORKERS', os.cpu_count() or 1))
+
+    async def get(self, path: Path, width: int, image_format: str = 'webp') -> Path:
+        """Get a resized and re-encoded copy of an image in the media dir, rendering it if it is not cached.
+
+        :param path: path of the original image
+        :param width: requested width of the derivative
+        :param image_format: format of the derivative, webp or jpeg
+        :return: path of the derivative
+        """
+
+        width = next((bucket for bucket in WIDTH_BUCKETS if bucket >= width), WIDTH_BUCKETS[-1])
+        relative_path = path.relative_to(self.media_dir).with_suffix('')
+        destination = self.derivatives_dir.joinpath(relative_path, f'{width}.{image_format}')
+
+        # derivatives of an image that was replaced since, e.g. a profile image, are rendered again, and so are
+        # derivatives evicted by another process sharing the cache dir
+        await self._load_cache_entries()
+        try:
+            is_cached = path.stat().st_mtime <= destination.stat().st_mtime
+        except FileNotFoundError:
+            is_cached = False
+        if is_cached:
+            if destination in _cache_entries:
+                _cache_entries.move_to_end(destination)
+            else:
+                await self._add_cache_entry(destination)
+            return destination
+
+        # render the derivative, unless the same derivative is already being rendered
+        if destination not in _renderings:
+            _renderings[destination] = asyncio.ensure_future(
+                self._render(path, destination, width, image_format)
+            )
+        await asyncio.shield(_renderings[destination])
+        return destination
+
+    async def _render(self, path: Path, destination: Path, width: int, image_format: str):
+        """Render a derivative in the process pool and add it to the cache.
+
+        :param path: path of the original image
+        :param destination: path to save the derivative to
+        :param width: maximum width of the derivative
+        :param image_format: format of the derivative, webp or jpeg
+        """
+
+        global _process_pool
+
+        try:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.get_running_loop().run_in_executor(
+                _process_pool, _render_derivative, path, destination, width, FORMATS[image_format], self.quality
+            )
+            await self._add_cache_entry(destination)
+        finally:
+            _renderings.pop(destination, None)
+
+    async def _load_cache_entries(self):
+        """Load derivatives already in the cache dir, least recently used first."""
+
+        global _cache_entries, _cache_lock, _cache_size
+
+        if _cache_lock is None:
+            _cache_lock = asyncio.Lock()
+        async with _cache_lock:
+            if _cache_entries is not None:
+                return
+
+            _cache_entries = await asyncio.get_running_loop().run_in_executor(None, _scan_cache, self.derivatives_dir)
+            _cache_size = sum(_cache_entries.values())
+
+    async def _add_cache_entry(self, path: Path):
+        """Add a derivative to the cache, and evict least recently used ones if it is too big.
+
+        The index only knows the derivatives of this process and the ones found at the last scan, so the cache dir is
+        scanned again, and evicted from, once the index is too big, or an eighth of the maximum size was added since
+        the last scan.
+
+        :param path: path of the derivative
+        """
+
+        global _cache_entries, _cache_size, _cache_added_since_scan
+
+        async with _cache_lock:
+            _cache_size -= _cache_entries.pop(path, 0)
+            try:
+                _cache_entries[path] = path.stat().st_size
+            except FileNotFoundError:
+                return
+            _cache_size += _cache_entries[path]
+            _cache_added_since_scan += _cache_entries[path]
+
+            if _cache_size > self.max_cache_size or _cache_added_since_scan > self.max_cache_size // 8:
+                _cache_entries = await asyncio.get_running_loop().run_in_executor(
+                    None, _evict_derivatives, self.derivatives_dir, self.max_cache_size
+                )
+                _cache_size = sum(_cache_entries.values())
+                _cache_added_since_scan = 0
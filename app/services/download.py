@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http import HTTPStatus
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from services import schema
+from services.base import BaseService
+from .exceptions import DownloadFailed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CircuitBreaker:
+    consecutive_failures: int = 0
+    opened_at: Optional[float] = None
+
+
+# circuit breakers of CDN hosts, shared by all download services of the process
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+class DownloadService(BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_attempts = int(os.getenv('DOWNLOAD_MAX_ATTEMPTS', 5))
+        self.backoff_base = float(os.getenv('DOWNLOAD_BACKOFF_BASE', 1))
+        self.backoff_max = float(os.getenv('DOWNLOAD_BACKOFF_MAX', 60))
+        self.circuit_breaker_threshold = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 5))
+        self.circuit_breaker_cooldown = float(os.getenv('CIRCUIT_BREAKER_COOLDOWN', 60))
+
+    async def download(
+        self,
+        url: str,
+        working_dir: Path,
+        filename: str,
+        timestamp: Optional[datetime] = None,
+        shortcode: Optional[str] = None,
+    ) -> Path:
+        """Download a file, retrying transient failures with jittered exponential backoff.
+
+        Hosts that keep failing are short-circuited for a while. Downloads that still fail are recorded in the
+        failed downloads table, and the record is cleared once the same file is downloaded successfully.
+
+        :param url: the url to retrieve the file
+        :param working_dir: the dir to save the file
+        :param filename: filename the file should be saved as (without extension)
+        :param timestamp: access and update time of the file
+        :param shortcode: shortcode of the post the file belongs to
+        :return: the path of the saved image or video
+        """
+
+        host = urlparse(url).hostname
+        circuit_breaker = _circuit_breakers.setdefault(host, CircuitBreaker())
+        path = str(working_dir.joinpath(filename).relative_to(self.media_dir))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._check_circuit_breaker(host, circuit_breaker)
+                file_path = await self._download(url, working_dir, filename, timestamp)
+            except DownloadFailed as e:
+                await self._record_failure(path, url, shortcode, e.reason, attempt)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = str(e) or e.__class__.__name__
+                if not self._is_retryable(e):
+                    await self._record_failure(path, url, shortcode, reason, attempt)
+                    raise DownloadFailed(url, reason) from e
+                self._on_failure(host, circuit_breaker)
+                if attempt >= self.max_attempts:
+                    await self._record_failure(path, url, shortcode, reason, attempt)
+                    raise DownloadFailed(url, reason) from e
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                logger.debug(f'Download of {url} failed ({reason}), retrying in {delay:.1f}s.')
+                await asyncio.sleep(delay)
+            else:
+                circuit_breaker.consecutive_failures = 0
+                circuit_breaker.opened_at = None
+                await self._clear_failure(path)
+                return file_path
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """Check if a failed download is worth retrying.
+
+        :param error: the error the download failed with
+        :return: if the error is transient
+        """
+
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500 or error.status in [
+                HTTPStatus.REQUEST_TIMEOUT,
+                HTTPStatus.TOO_MANY_REQUESTS,
+                HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+            ]
+        return True
+
+    def _check_circuit_breaker(self, host: str, circuit_breaker: CircuitBreaker):
+        """Fail fast if the circuit breaker of a host is open.
+
+        Once the cooldown has passed, requests are let through again, and the first failure reopens the breaker.
+
+        :param host: the host to download from
+        :param circuit_breaker: the circuit breaker of the host
+        """
+
+        if circuit_breaker.opened_at is None:
+            return
+        if time.monotonic() - circuit_breaker.opened_at < self.circuit_breaker_cooldown:
+            raise DownloadFailed(host, 'circuit breaker is open')
+        circuit_breaker.consecutive_failures = self.circuit_breaker_threshold - 1
+        circuit_breaker.opened_at = None
+
+    def _on_failure(self, host: str, circuit_breaker: CircuitBreaker):
+        """Count a failure against a host and open its circuit breaker if the threshold is reached.
+
+        :param host: the host the download failed from
+        :param circuit_breaker: the circuit breaker of the host
+        """
+
+        circuit_breaker.consecutive_failures += 1
+        if circuit_breaker.consecutive_failures >= self.circuit_breaker_threshold:
+            circuit_breaker.opened_at = time.monotonic()
+            logger.warning(f'Circuit breaker opened for host {host}.')
+
+    async def _record_failure(self, path: str, url: str, shortcode: Optional[str], reason: str, attempts: int):
+        """Record a failed download in the failed downloads table.
+
+        :param path: destination of the file relative to the media dir (without extension)
+        :param url: the url of the file
+        :param shortcode: shortcode of the post the file belongs to
+        :param reason: the reason of the failure
+        :param attempts: the number of attempts made
+        """
+
+        logger.warning(f'Failed to download {path}: {reason}.')
+        values = {
+            'path': path,
+            'url': url,
+            'shortcode': shortcode,
+            'reason': reason,
+            'attempts': attempts,
+            'last_attempt': datetime.now(timezone.utc),
+        }
+        statement = insert(schema.failed_downloads).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[schema.failed_downloads.c.path],
+            set_={
+                'url': statement.excluded.url,
+                'reason': statement.excluded.reason,
+                'attempts': schema.failed_downloads.c.attempts + statement.excluded.attempts,
+                'last_attempt': statement.excluded.last_attempt,
+            },
+        )
+        await self.database.execute(statement)
+
+    async def _clear_failure(self, path: str):
+        """Remove the record of a file from the failed downloads table.
+
+        :param path: destination of the file relative to the media dir (without extension)
+        """
+
+        statement = sa.delete(schema.failed_downloads).where(schema.failed_downloads.c.path == path)
+        await self.database.execute(statement)
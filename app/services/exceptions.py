@@ -11,3 +11,31 @@ class PostNotFound(Exception):
     @property
     def response(self):
         return {'event': self.event_code, 'shortcode': self.shortcode, 'message': self.message}
+
+
+class ProfileNotFound(Exception):
+    def __init__(self, username):
+        self.username = username
+
+    @property
+    def message(self):
+        return f'Profile with username {self.username} does not exist.'
+
+
+class DownloadFailed(Exception):
+    def __init__(self, url, reason):
+        self.url = url
+        self.reason = reason
+
+    @property
+    def message(self):
+        return f'Failed to download {self.url}: {self.reason}.'
+
+
+class InvalidCursor(Exception):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def message(self):
+        return f'Cursor {self.cursor} is invalid.'
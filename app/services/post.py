@@ -1,10 +1,12 @@
 import asyncio
+import base64
+import json
 import logging
 import os
-import random
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Optional
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
 
 import instaloader
 import pydantic
@@ -15,11 +17,21 @@ from entities.enums import PostType, PostItemType
 from entities.posts import Post, PostItem, PostListResult, PostArchiveRequest
 from services import schema
 from services.base import BaseService
+from services.bloom import BloomFilter
+from services.download import DownloadService
 from services.profile import ProfileService
-from .exceptions import PostNotFound
+from services.rate_limit import next_with_backoff
+from services.stats import ProfileStatsService
+from .exceptions import DownloadFailed, InvalidCursor, PostNotFound, ProfileNotFound
 
 logger = logging.getLogger(__name__)
 
+# channel notified with the shortcodes of newly archived posts, which keeps the known shortcode filters current
+POSTS_CHANNEL = 'posts'
+
+# filter of archived shortcodes shared by all post services of the process, only set while it is kept current
+_known_shortcodes: Optional[BloomFilter] = None
+
 
 @dataclass
 class DownloadTask:
@@ -27,7 +39,85 @@ class DownloadTask:
     thumb_url: Optional[str] = None
 
 
+def _encode_cursor(post: Post, is_backward: bool) -> str:
+    """Encode the position of a post into an opaque cursor.
+
+    :param post: the first or last post of a page
+    :param is_backward: if the cursor points to the posts before (newer than) the post
+    :return: the cursor
+    """
+
+    data = {'timestamp': post.timestamp.isoformat(), 'shortcode': post.shortcode, 'is_backward': is_backward}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[bool, datetime, str]:
+    """Decode an opaque cursor.
+
+    :param cursor: the cursor
+    :return: direction, and timestamp and shortcode of the post the cursor points from
+    """
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        timestamp = datetime.utcfromtimestamp(datetime.fromisoformat(data['timestamp']).timestamp())
+        return bool(data['is_backward']), timestamp, str(data['shortcode'])
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def _convert_instaloader_post(post: instaloader.Post) -> Tuple[Post, List[PostItem], List[DownloadTask]]:
+    """Convert an instaloader post to post metadata, which may query Instagram for lazily fetched attributes.
+
+    :param post: the instaloader post
+    :return: post metadata without items, its items, and the downloads of each item
+    """
+
+    # figure out post_type, items and download_tasks
+    if post.typename == 'GraphImage':
+        post_type = PostType.IMAGE
+        items = [PostItem(index=0, type=PostItemType.IMAGE)]
+        download_tasks = [DownloadTask(url=post.url)]
+    elif post.typename == 'GraphVideo':
+        post_type = PostType.VIDEO
+        items = [PostItem(index=0, type=PostItemType.VIDEO, duration=post.video_duration)]
+        download_tasks = [DownloadTask(url=post.video_url, thumb_url=post.url)]
+    elif post.typename == 'GraphSidecar':
+        post_type = PostType.SIDECAR
+        items, download_tasks = [], []
+        for index, node in enumerate(post.get_sidecar_nodes()):
+            post_item = PostItem(index=index, type=PostItemType.VIDEO if node.is_video else PostItemType.IMAGE)
+            download_task = DownloadTask(
+                url=node.video_url if node.is_video else node.display_url,
+                thumb_url=node.display_url if node.is_video else None,
+            )
+            items.append(post_item)
+            download_tasks.append(download_task)
+    else:
+        post_type = None
+        items, download_tasks = [], []
+
+    # convert instaloader post to Post object
+    post = Post(
+        shortcode=post.shortcode,
+        username=post.owner_username,
+        timestamp=post.date_utc,
+        type=post_type,
+        caption=post.caption,
+        caption_hashtags=post.caption_hashtags,
+        caption_mentions=post.caption_mentions,
+        items=[],
+    )
+    return post, items, download_tasks
+
+
 class PostService(BaseService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.known_shortcodes_capacity = int(os.getenv('KNOWN_SHORTCODES_CAPACITY', 1000000))
+        self.known_shortcodes_error_rate = float(os.getenv('KNOWN_SHORTCODES_ERROR_RATE', 0.001))
+        self.fetch_chunk_size = int(os.getenv('PIPELINE_DEPTH', 8))
+
     async def list(
         self,
         offset: int = 0,
@@ -36,18 +126,95 @@ class PostService(BaseService):
         start_time: Optional[datetime] = None,
         end_time: Optional[datetime] = None,
         shortcode: Optional[str] = None,
+        cursor: Optional[str] = None,
+        with_count: bool = True,
+        search: Optional[str] = None,
+        hashtags: Optional[List[str]] = None,
+        mentions: Optional[List[str]] = None,
     ) -> PostListResult:
         """List posts.
 
-        :param offset: the number of posts to skip
+        Posts are ordered by timestamp and shortcode, newest first. Pages can be fetched either by offset, or by
+        the cursors returned with the previous page, which costs the same no matter how deep the page is.
+
+        :param offset: the number of posts to skip, ignored when a cursor is given
         :param limit: the number of posts to fetch
         :param username: username of post owner to filter
         :param start_time: the start of creation time to filter posts
         :param end_time: the end of creation time to filter posts
         :param shortcode: shortcode of post to filter
+        :param cursor: next or previous cursor of a page to fetch the adjacent page
+        :param with_count: if the total number of posts should be counted
+        :param search: text query the caption must match, in web search syntax (e.g. "sunset -beach")
+        :param hashtags: hashtags the caption must all contain
+        :param mentions: usernames the caption must all mention
         :return: the list query result
         """
 
+        query, count_query, is_backward = self._build_list_queries(
+            offset, limit, username, start_time, end_time, shortcode, cursor, search, hashtags, mentions
+        )
+        if cursor:
+            offset = 0
+
+        # format the results
+        posts = []
+        count = await self.database.fetch_val(count_query) if with_count else None
+        for result in await self.database.fetch_all(query):
+            if not posts or posts[-1].shortcode != result['shortcode']:
+                try:
+                    post = Post(items=[], **dict(result))
+                    post.timestamp = post.timestamp.replace(tzinfo=timezone.utc)
+                    posts.append(post)
+                except pydantic.error_wrappers.ValidationError:
+                    continue
+            try:
+                item = PostItem(
+                    index=result['item_index'],
+                    type=result['item_type'],
+                    duration=result['item_duration'],
+                    filename=result['item_filename'],
+                    thumb_image_filename=result['item_thumb_image_filename'],
+                )
+                posts[-1].items.append(item)
+            except pydantic.error_wrappers.ValidationError:
+                continue
+
+        # drop the extra post, which is the newest one when paging backward
+        has_more = len(posts) > limit
+        if has_more:
+            posts = posts[1:] if is_backward else posts[:-1]
+        has_next = has_more if not is_backward else cursor is not None
+        has_previous = has_more if is_backward else cursor is not None or offset > 0
+
+        return PostListResult(
+            posts=posts,
+            limit=limit,
+            offset=offset,
+            count=count,
+            next_cursor=_encode_cursor(posts[-1], is_backward=False) if posts and has_next else None,
+            previous_cursor=_encode_cursor(posts[0], is_backward=True) if posts and has_previous else None,
+        )
+
+    def _build_list_queries(
+        self,
+        offset: int,
+        limit: int,
+        username: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        shortcode: Optional[str] = None,
+        cursor: Optional[str] = None,
+        search: Optional[str] = None,
+        hashtags: Optional[List[str]] = None,
+        mentions: Optional[List[str]] = None,
+    ) -> Tuple[sa.sql.Select, sa.sql.Select, bool]:
+        """Build the queries listing posts, see list for the parameters.
+
+        :return: query of the posts of the page and their items, count query of all posts, and if the page is
+        fetched backward
+        """
+
         # build base query
         condition = []
         if username:
@@ -60,15 +227,34 @@ class PostService(BaseService):
             condition.append(schema.posts.c.timestamp < end_time)
         if shortcode:
             condition.append(schema.posts.c.shortcode == shortcode)
-        base_cte = schema.posts.select().where(*condition).cte('base')
-
-        # build post and count cte
-        posts_cte = base_cte.select().order_by(base_cte.c.timestamp.desc()) \
-            .offset(offset).limit(limit).cte('posts')
-        count_cte = sa.select(sa.func.count().label('total_count')).select_from(base_cte).cte('count')
+        if search:
+            query = sa.func.websearch_to_tsquery(sa.literal_column(f"'{schema.text_search_config}'"), search)
+            condition.append(schema.caption_tsv.op('@@')(query))
+        if hashtags:
+            hashtags = [hashtag.lstrip('#').lower() for hashtag in hashtags]
+            condition.append(schema.posts.c.caption_hashtags.contains(hashtags))
+        if mentions:
+            mentions = [mention.lstrip('@').lower() for mention in mentions]
+            condition.append(schema.posts.c.caption_mentions.contains(mentions))
+        base_cte = sa.select(schema.posts).where(*condition).cte('base')
+
+        # build post cte, fetching one extra post to find out if there are more posts after the page
+        is_backward = False
+        if cursor:
+            is_backward, cursor_timestamp, cursor_shortcode = _decode_cursor(cursor)
+            key = sa.tuple_(base_cte.c.timestamp, base_cte.c.shortcode)
+            cursor_key = sa.tuple_(sa.literal(cursor_timestamp), sa.literal(cursor_shortcode))
+            posts_query = base_cte.select().where(key > cursor_key if is_backward else key < cursor_key)
+        else:
+            posts_query = base_cte.select().offset(offset)
+        if is_backward:
+            posts_query = posts_query.order_by(base_cte.c.timestamp.asc(), base_cte.c.shortcode.asc())
+        else:
+            posts_query = posts_query.order_by(base_cte.c.timestamp.desc(), base_cte.c.shortcode.desc())
+        posts_cte = posts_query.limit(limit + 1).cte('posts')
 
         # build final query
-        query = sa.select(
+        columns = [
             posts_cte.c.shortcode,
             posts_cte.c.username,
             posts_cte.c.timestamp,
@@ -81,39 +267,20 @@ class PostService(BaseService):
             schema.post_items.c.duration.label('item_duration'),
             schema.post_items.c.filename.label('item_filename'),
             schema.post_items.c.thumb_image_filename.label('item_thumb_image_filename'),
-            count_cte.c.total_count.label('total_count'),
-        ).select_from(
-            posts_cte.outerjoin(
-                schema.post_items,
-                posts_cte.c.shortcode == schema.post_items.c.shortcode,
-                full=False,
-            ).outerjoin(count_cte, sa.sql.true(), full=True)
-        ).order_by(posts_cte.c.timestamp.desc(), schema.post_items.c.index.asc())
-
-        # format the results
-        posts, count = [], 0
-        for result in await self.database.fetch_all(query):
-            count = result['total_count']
-            if not posts or posts[-1].shortcode != result['shortcode']:
-                try:
-                    post = Post(items=[], **dict(result))
-                    post.timestamp = post.timestamp.replace(tzinfo=timezone.utc)
-                    posts.append(post)
-                except pydantic.error_wrappers.ValidationError:
-                    continue
-            try:
-                item = PostItem(
-                    index=result['item_index'],
-                    type=result['item_type'],
-                    duration=result['item_duration'],
-                    filename=result['item_filename'],
-                    thumb_image_filename=result['item_thumb_image_filename'],
-                )
-                posts[-1].items.append(item)
-            except pydantic.error_wrappers.ValidationError:
-                continue
+        ]
+        from_clause = posts_cte.outerjoin(
+            schema.post_items,
+            posts_cte.c.shortcode == schema.post_items.c.shortcode,
+            full=False,
+        )
+        query = sa.select(*columns).select_from(from_clause).order_by(
+            posts_cte.c.timestamp.desc(), posts_cte.c.shortcode.desc(), schema.post_items.c.index.asc()
+        )
 
-        return PostListResult(posts=posts, limit=limit, offset=offset, count=count)
+        # build count query, separately, as a cte referenced by both queries would be materialized before the
+        # limit is applied, and the posts could no longer be read in index order
+        count_query = sa.select(sa.func.count()).select_from(base_cte)
+        return query, count_query, is_backward
 
     async def get(self, shortcode: str) -> Optional[Post]:
         """Retrieve post.
@@ -128,40 +295,139 @@ class PostService(BaseService):
     async def exists(self, shortcode: str) -> bool:
         """Check if a post exists.
 
+        Shortcodes missing from the known shortcode filter are not looked up in the database.
+
         :param shortcode: shortcode of the post to check
         :return: if the post exists
         """
 
+        if not self.might_exist(shortcode):
+            return False
+
         select_statement = sa.select(schema.posts.c.shortcode).where(schema.posts.c.shortcode == shortcode)
         exists_statement = sa.select(sa.exists(select_statement))
         return await self.database.fetch_val(query=exists_statement)
 
+    async def exists_many(self, shortcodes: List[str]) -> Set[str]:
+        """Check which of many posts exist, with at most one query.
+
+        :param shortcodes: shortcodes of the posts to check
+        :return: shortcodes of the posts that exist
+        """
+
+        candidates = {shortcode for shortcode in shortcodes if self.might_exist(shortcode)}
+        if not candidates:
+            return set()
+
+        statement = sa.select(schema.posts.c.shortcode).where(schema.posts.c.shortcode.in_(candidates))
+        return {row['shortcode'] for row in await self.database.fetch_all(statement)}
+
+    @staticmethod
+    def might_exist(shortcode: str) -> bool:
+        """Check if a post may exist, without a query.
+
+        Every post is reported as possibly existing while the known shortcode filter isn't kept current.
+
+        :param shortcode: shortcode of the post to check
+        :return: False if the post doesn't exist, True if it may
+        """
+
+        return _known_shortcodes is None or shortcode in _known_shortcodes
+
+    async def track_known_shortcodes(self):
+        """Load the shortcodes of all archived posts into the known shortcode filter, and keep it current until
+        cancelled.
+
+        Posts archived by any process are added as the notifications of their transactions arrive, and the filter is
+        loaded again once it holds more shortcodes than it was sized for. A post archived by another process may be
+        missing for the moment its notification is in flight, in which case it is only downloaded again.
+        """
+
+        global _known_shortcodes
+
+        filled = asyncio.Event()
+        pending: Optional[List[str]] = None
+
+        def on_notification(*args):
+            shortcodes = args[-1].split(',')
+            if pending is not None:
+                pending.extend(shortcodes)
+            if _known_shortcodes is not None:
+                for shortcode in shortcodes:
+                    _known_shortcodes.add(shortcode)
+                if _known_shortcodes.count > _known_shortcodes.capacity:
+                    filled.set()
+
+        try:
+            async with self.database.connection() as connection:
+                # listen before loading, so that no post archived in the meantime is missed
+                await connection.raw_connection.add_listener(POSTS_CHANNEL, on_notification)
+                while True:
+                    pending = []
+                    rows = await self.database.fetch_all(sa.select(schema.posts.c.shortcode))
+                    known_shortcodes = BloomFilter(
+                        max(self.known_shortcodes_capacity, 2 * len(rows)), self.known_shortcodes_error_rate
+                    )
+                    for shortcode in [row['shortcode'] for row in rows] + pending:
+                        known_shortcodes.add(shortcode)
+                    _known_shortcodes, pending = known_shortcodes, None
+                    logger.info(f'Loaded {len(rows)} known shortcode(s).')
+
+                    filled.clear()
+                    await filled.wait()
+        finally:
+            _known_shortcodes = None
+
     async def update_username(self, shortcode: str, username: str):
         """Reassign post to another username.
 
+        Files are moved within the transaction, and moved back if it doesn't commit.
+
         :param shortcode: shortcode of the post
         :param username: username the post will be associated with
         """
 
-        # move files
-        statement = sa.select(schema.posts.c.username, schema.post_items.c.filename) \
-            .select_from(
-                schema.posts.join(schema.post_items, schema.posts.c.shortcode == schema.post_items.c.shortcode)
-            ).where(schema.posts.c.shortcode == shortcode)
-        rows = await self.database.fetch_all(statement)
-        for row in rows:
-            old_path = self.post_dir.joinpath(row['username'], row['filename'])
-            new_path = self.post_dir.joinpath(username, row['filename'])
-            old_path.rename(new_path)
-
-        # update database
-        statement = sa.update(schema.posts) \
-            .where(schema.posts.c.shortcode == shortcode) \
-            .values(username=username) \
-            .returning(schema.posts.c.shortcode)
-        updated = await self.database.fetch_val(statement)
-        if not updated:
-            raise PostNotFound(shortcode)
+        moved_paths = []
+        try:
+            async with self.database.transaction():
+                statement = sa.select(schema.posts.c.username, schema.posts.c.timestamp) \
+                    .where(schema.posts.c.shortcode == shortcode) \
+                    .with_for_update()
+                post = await self.database.fetch_one(statement)
+                if not post:
+                    raise PostNotFound(shortcode)
+
+                # keep the profile from being deleted until the post is reassigned
+                statement = sa.select(schema.profiles.c.username) \
+                    .where(schema.profiles.c.username == username) \
+                    .with_for_update(read=True)
+                if not await self.database.fetch_one(statement):
+                    raise ProfileNotFound(username)
+
+                # move files
+                statement = sa.select(schema.post_items.c.filename).where(schema.post_items.c.shortcode == shortcode)
+                rows = await self.database.fetch_all(statement)
+                for row in rows:
+                    old_path = self.post_dir.joinpath(post['username'], row['filename'])
+                    new_path = self.post_dir.joinpath(username, row['filename'])
+                    new_path.parent.mkdir(parents=True, exist_ok=True)
+                    old_path.rename(new_path)
+                    moved_paths.append((old_path, new_path))
+
+                # update database
+                statement = sa.update(schema.posts) \
+                    .where(schema.posts.c.shortcode == shortcode) \
+                    .values(username=username)
+                await self.database.execute(statement)
+
+                # update stats of both profiles
+                stats_service = ProfileStatsService(self.database, self.http_session)
+                await stats_service.refresh(post['username'], post['timestamp'])
+                await stats_service.add(username, post['timestamp'])
+        except BaseException:
+            for old_path, new_path in reversed(moved_paths):
+                new_path.rename(old_path)
+            raise
 
     async def delete(self, shortcode: str, index: Optional[int] = None):
         """Delete post and post items
@@ -174,6 +440,7 @@ class PostService(BaseService):
             # find info about post items
             list_statement = sa.select([
                 schema.posts.c.username,
+                schema.posts.c.timestamp,
                 schema.post_items.c.index,
                 schema.post_items.c.type,
                 schema.post_items.c.filename,
@@ -188,9 +455,9 @@ class PostService(BaseService):
                 if index is not None and item['index'] != index:
                     continue
                 if filename := item['filename']:
-                    self.delete_file(self.post_dir, item['username'], filename)
+                    await self.delete_file(self.post_dir, item['username'], filename)
                 if thumb_image_filename := item['thumb_image_filename']:
-                    self.delete_file(self.thumb_images_dir, item['username'], thumb_image_filename)
+                    await self.delete_file(self.thumb_images_dir, item['username'], thumb_image_filename)
 
             # delete post(if deleting post or post has only one item left) and post item records
             if index is not None:
@@ -205,6 +472,9 @@ class PostService(BaseService):
             if len(post_items) == 1 or index is None:
                 delete_statement = sa.delete(schema.posts).where(schema.posts.c.shortcode == shortcode)
                 await self.database.execute(delete_statement)
+                if post_items:
+                    stats_service = ProfileStatsService(self.database, self.http_session)
+                    await stats_service.refresh(post_items[0]['username'], post_items[0]['timestamp'])
 
     async def create_from_shortcode(self, shortcode: str) -> Post:
         """Create a post from a shortcode.
@@ -239,10 +509,9 @@ class PostService(BaseService):
 
         count = 0
         while True:
-            # fetch the next post
-            try:
-                post: instaloader.Post = await loop.run_in_executor(None, next, post_iterator)
-            except StopIteration:
+            # fetch the next post, pausing in place if Instagram pushes back
+            post: instaloader.Post = await next_with_backoff(post_iterator)
+            if post is None:
                 logger.debug('Unable to get the next post.')
                 break
 
@@ -261,12 +530,8 @@ class PostService(BaseService):
                 break
 
             # save post
-            await self.create_from_instaloader(post)
-            count += 1
-
-            # sleep for a random amount of time
-            max_sleep = os.environ.get('MAX_SLEEP', 60)
-            await asyncio.sleep(random.randint(0, max_sleep))
+            if await self.create_from_instaloader(post):
+                count += 1
         logger.info(
             f'Saved {count} post(s) for profile {request.username} from {request.start} to {request.end}.'
         )
@@ -289,107 +554,106 @@ class PostService(BaseService):
 
         total_counter = 0
         archived_counter = 0
-        while True:
-            # fetch the next post
-            try:
-                post: instaloader.Post = await loop.run_in_executor(None, next, post_iterator)
+        is_stopped = False
+        while not is_stopped:
+            # fetch the next chunk of posts, pausing in place if Instagram pushes back, up to the first one that may be
+            # archived already, so that they are looked up with one query per chunk
+            chunk = []
+            while len(chunk) < self.fetch_chunk_size and (not count or total_counter < count):
+                post: instaloader.Post = await next_with_backoff(post_iterator)
+                if post is None:
+                    is_stopped = True
+                    break
                 total_counter += 1
                 logger.debug(f'Fetched post: {post.shortcode}')
-            except StopIteration:
-                break
-
-            # if the current post already exists,
-            # end the loop if not trying to archive certain amount of most recent posts
-            if await self.exists(post.shortcode):
-                if count is None:
+                chunk.append(post)
+                if self.might_exist(post.shortcode):
                     break
-                else:
-                    continue
-
-            # archive unsaved post and increment the counter
-            await self.create_from_instaloader(post)
-            archived_counter += 1
-
-            # sleep for a random amount of time
-            max_sleep = os.environ.get('MAX_SLEEP', 60)
-            await asyncio.sleep(random.randint(0, max_sleep))
+            if not chunk:
+                break
 
-            # break if already iterated through enough posts
+            existing = await self.exists_many([post.shortcode for post in chunk])
+            for post in chunk:
+                # if the current post already exists,
+                # end the loop if not trying to archive certain amount of most recent posts
+                if post.shortcode in existing:
+                    if count is None:
+                        is_stopped = True
+                        break
+                    else:
+                        continue
+
+                # archive unsaved post and increment the counter
+                if await self.create_from_instaloader(post):
+                    archived_counter += 1
+
+            # stop if already iterated through enough posts
             if count and total_counter >= count:
                 break
 
         logger.info(f'Archived {archived_counter} saved post(s).')
 
-    async def create_from_instaloader(self, post: instaloader.Post) -> Post:
+    async def create_from_failed_downloads(self):
+        """Create posts that were skipped because some of their media failed to download."""
+
+        statement = sa.select(schema.failed_downloads.c.shortcode) \
+            .where(schema.failed_downloads.c.shortcode.isnot(None)) \
+            .distinct()
+        shortcodes = [row['shortcode'] for row in await self.database.fetch_all(statement)]
+
+        count = 0
+        for shortcode in shortcodes:
+            if await self.create_from_shortcode(shortcode):
+                count += 1
+        logger.info(f'Created {count} of {len(shortcodes)} post(s) from failed downloads.')
+
+    async def create_from_instaloader(self, post: instaloader.Post, persist: bool = True) -> Optional[Post]:
         """Create a post from a instaloader post object.
 
         :param post: a instaloader post object
+        :param persist: if the post should be saved, otherwise only its media is downloaded, and the caller saves it,
+        e.g. with other posts through upsert_many
+        :return: post metadata, or None if the media of the post could not be downloaded
         """
 
-        # figure out post_type, items and download_tasks
-        if post.typename == 'GraphImage':
-            post_type = PostType.IMAGE
-            items = [PostItem(index=0, type=PostItemType.IMAGE)]
-            download_tasks = [DownloadTask(url=post.url)]
-        elif post.typename == 'GraphVideo':
-            post_type = PostType.VIDEO
-            items = [PostItem(index=0, type=PostItemType.VIDEO, duration=post.video_duration)]
-            download_tasks = [DownloadTask(url=post.video_url, thumb_url=post.url)]
-        elif post.typename == 'GraphSidecar':
-            post_type = PostType.SIDECAR
-            items, download_tasks = [], []
-            for index, node in enumerate(post.get_sidecar_nodes()):
-                post_item = PostItem(index=index, type=PostItemType.VIDEO if node.is_video else PostItemType.IMAGE)
-                download_task = DownloadTask(
-                    url=node.video_url if node.is_video else node.display_url,
-                    thumb_url=node.display_url if node.is_video else None,
-                )
-                items.append(post_item)
-                download_tasks.append(download_task)
-        else:
-            post_type = None
-            items, download_tasks = [], []
-
-        # convert instaloader post to Post object
-        post = Post(
-            shortcode=post.shortcode,
-            username=post.owner_username,
-            timestamp=post.date_utc,
-            type=post_type,
-            caption=post.caption,
-            caption_hashtags=post.caption_hashtags,
-            caption_mentions=post.caption_mentions,
-            items=[],
-        )
+        # resolve the metadata in a thread, some of its attributes are fetched lazily and wait for rate limits
+        loop = asyncio.get_running_loop()
+        post, items, download_tasks = await loop.run_in_executor(None, _convert_instaloader_post, post)
 
-        # create profile if not exist
-        profile_service = ProfileService(self.database, self.http_session)
-        if not await profile_service.exists(post.username):
-            await profile_service.upsert(post.username)
-
-        # download image and videos
-        post_filename = f'{post.timestamp.strftime("%Y-%m-%dT%H-%M-%S")}_[{post.shortcode}]'
-        for item, download_task in zip(items, download_tasks):
-            filename = f'{post_filename}_{item.index}' if len(items) > 1 else post_filename
-            file_path = self._download(
-                download_task.url,
-                self.post_dir.joinpath(post.username),
-                filename,
-                post.timestamp
-            )
-            item.filename = file_path.name
-            if download_task.thumb_url:
-                file_path = self._download(
-                    download_task.thumb_url,
-                    self.thumb_images_dir.joinpath(post.username),
-                    filename,
-                    post.timestamp,
+        try:
+            # create profile if not exist
+            profile_service = ProfileService(self.database, self.http_session)
+            if not await profile_service.exists(post.username):
+                await profile_service.upsert(post.username)
+
+            # download images and videos, items and their thumb images are fetched concurrently
+            post_filename = f'{post.timestamp.strftime("%Y-%m-%dT%H-%M-%S")}_[{post.shortcode}]'
+            download_service = DownloadService(self.database, self.http_session)
+            semaphore = asyncio.Semaphore(self.max_concurrent_post_downloads)
+            results = await asyncio.gather(*[
+                self._download_item(
+                    item,
+                    download_task,
+                    post,
+                    f'{post_filename}_{item.index}' if len(items) > 1 else post_filename,
+                    download_service,
+                    semaphore,
                 )
-                item.thumb_image_filename = file_path.name
+                for item, download_task in zip(items, download_tasks)
+            ], return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        except DownloadFailed as e:
+            # failed downloads are recorded, and the post is left for a later retry
+            logger.warning(f'Skipped post {post.shortcode} of user {post.username}. {e.message}')
+            return None
 
         # upsert the post entity
         post.items = items
-        await self._upsert(post)
+        if not persist:
+            return post
+        await self.upsert_many([post])
 
         logger.info(
             f'Saved post {post.shortcode} of user {post.username} '
@@ -397,30 +661,81 @@ class PostService(BaseService):
         )
         return post
 
-    async def _upsert(self, post: Post):
-        """Create or update a post.
+    async def _download_item(
+        self,
+        item: PostItem,
+        download_task: DownloadTask,
+        post: Post,
+        filename: str,
+        download_service: DownloadService,
+        semaphore: asyncio.Semaphore,
+    ):
+        """Download the file and the thumb image of a post item, and record their filenames on the item.
+
+        :param item: the post item to download
+        :param download_task: urls of the file and the thumb image of the post item
+        :param post: the post the item belongs to
+        :param filename: filename the files should be saved as (without extension)
+        :param download_service: the service to download the files with
+        :param semaphore: limits the number of concurrent downloads of the post
+        """
+
+        async def download(url: str, working_dir: Path):
+            async with semaphore:
+                return await download_service.download(url, working_dir, filename, post.timestamp, post.shortcode)
+
+        if download_task.thumb_url:
+            file_path, thumb_path = await asyncio.gather(
+                download(download_task.url, self.post_dir.joinpath(post.username)),
+                download(download_task.thumb_url, self.thumb_images_dir.joinpath(post.username)),
+            )
+            item.thumb_image_filename = thumb_path.name
+        else:
+            file_path = await download(download_task.url, self.post_dir.joinpath(post.username))
+        item.filename = file_path.name
 
-        :param post: post metadata
+    async def upsert_many(self, posts: List[Post]):
+        """Create or update posts and their items, with one statement per table.
+
+        :param posts: metadata of the posts
         """
 
+        # keep the last version of each post, a statement can't upsert the same row twice
+        posts = sorted({post.shortcode: post for post in posts}.values(), key=lambda post: post.shortcode)
+        if not posts:
+            return
+
         async with self.database.transaction():
-            values = {
-                'shortcode': post.shortcode,
-                'username': post.username,
-                'timestamp': post.timestamp,
-                'type': post.type.value,
-                'caption': post.caption,
-                'caption_hashtags': post.caption_hashtags,
-                'caption_mentions': post.caption_mentions,
-            }
-            updates = values.copy()
-            updates.pop('shortcode')
-            statement = insert(schema.posts).values(**values)
-            statement = statement.on_conflict_do_update(index_elements=[schema.posts.c.shortcode], set_=updates)
-            await self.database.execute(statement)
-
-            for item in post.items:
-                values = {
+            # find the current owners and timestamps of the posts, to keep the profile stats current
+            statement = sa.select(schema.posts.c.shortcode, schema.posts.c.username, schema.posts.c.timestamp) \
+                .where(schema.posts.c.shortcode.in_([post.shortcode for post in posts])) \
+                .with_for_update()
+            existing = {row['shortcode']: row for row in await self.database.fetch_all(statement)}
+
+            statement = insert(schema.posts).values([
+                {
+                    'shortcode': post.shortcode,
+                    'username': post.username,
+                    'timestamp': post.timestamp,
+                    'type': post.type.value,
+                    'caption': post.caption,
+                    'caption_hashtags': post.caption_hashtags,
+                    'caption_mentions': post.caption_mentions,
+                }
+                for post in posts
+            ])
+            statement = statement.on_conflict_do_update(
+                index_elements=[schema.posts.c.shortcode],
+                set_={
+                    column: statement.excluded[column]
+                    for column in ['username', 'timestamp', 'type', 'caption', 'caption_hashtags', 'caption_mentions']
+                },
+            ).returning(schema.posts.c.shortcode, sa.literal_column('(xmax = 0)').label('is_inserted'))
+            rows = await self.database.fetch_all(statement)
+            inserted = {row['shortcode'] for row in rows if row['is_inserted']}
+
+            items = [
+                {
                     'shortcode': post.shortcode,
                     'index': item.index,
                     'type': item.type.value,
@@ -428,12 +743,37 @@ class PostService(BaseService):
                     'filename': item.filename,
                     'thumb_image_filename': item.thumb_image_filename,
                 }
-                updates = values.copy()
-                updates.pop('shortcode')
-                updates.pop('index')
-                statement = insert(schema.post_items).values(**values)
+                for post in posts for item in post.items
+            ]
+            if items:
+                statement = insert(schema.post_items).values(items)
                 statement = statement.on_conflict_do_update(
                     index_elements=[schema.post_items.c.shortcode, schema.post_items.c.index],
-                    set_=updates
+                    set_={
+                        column: statement.excluded[column]
+                        for column in ['type', 'duration', 'filename', 'thumb_image_filename']
+                    },
                 )
                 await self.database.execute(statement)
+
+            # tell every process about the new posts once the transaction commits
+            inserted_shortcodes = [post.shortcode for post in posts if post.shortcode in inserted]
+            for i in range(0, len(inserted_shortcodes), 100):
+                payload = ','.join(inserted_shortcodes[i:i + 100])
+                await self.database.execute(sa.select(sa.func.pg_notify(POSTS_CHANNEL, payload)))
+
+            # update profile stats, counting only the posts this statement inserted, as a concurrent transaction may
+            # have inserted a post that didn't exist yet when the current rows were read
+            stats_service = ProfileStatsService(self.database, self.http_session)
+            await stats_service.add_many([
+                (post.username, post.timestamp) for post in posts if post.shortcode in inserted
+            ])
+            for post in posts:
+                if post.shortcode in inserted:
+                    continue
+                row = existing.get(post.shortcode)
+                if not row:
+                    await stats_service.refresh(post.username, post.timestamp)
+                elif row['username'] != post.username or row['timestamp'] != post.timestamp:
+                    await stats_service.refresh(row['username'], row['timestamp'])
+                    await stats_service.refresh(post.username, post.timestamp)
@@ -1,6 +1,8 @@
 import asyncio
 import logging
 import shutil
+from datetime import datetime, timezone
+from typing import Optional, Tuple
 
 import instaloader
 import sqlalchemy as sa
@@ -9,6 +11,8 @@ from sqlalchemy.dialects.postgresql import insert
 from entities.profiles import ProfileUpdates
 from services import schema
 from services.base import BaseService
+from services.download import DownloadService
+from services.exceptions import DownloadFailed
 
 logger = logging.getLogger(__name__)
 
@@ -29,20 +33,28 @@ class ProfileService(BaseService):
             logger.warning(f'Profile does not exist: {username}')
             return
 
-        # save profile image
-        image_path = self._download(profile.profile_pic_url, self.profile_images_dir, profile.username)
+        # save profile image, whose url is fetched lazily, waiting for rate limits in a thread
+        profile_pic_url = await loop.run_in_executor(None, lambda: profile.profile_pic_url)
+        download_service = DownloadService(self.database, self.http_session)
+        try:
+            image_path = await download_service.download(profile_pic_url, self.profile_images_dir, profile.username)
+        except DownloadFailed as e:
+            logger.warning(f'Failed to update the image of profile {profile.username}: {e.message}')
+            image_path = None
 
-        # upsert profile
+        # upsert profile, keeping the current image if a new one couldn't be downloaded
         values = {
             'username': profile.username,
             'full_name': profile.full_name,
             'display_name': profile.full_name,
             'biography': profile.biography,
-            'image_filename': image_path.parts[-1],
+            'image_filename': image_path.parts[-1] if image_path else f'{profile.username}.jpg',
             'auto_archive': False,
         }
         updates = values.copy()
         updates.pop('username')
+        if not image_path:
+            updates.pop('image_filename')
         statement = insert(schema.profiles) \
             .values(**values) \
             .on_conflict_do_update(index_elements=[schema.profiles.c.username], set_=updates)
@@ -60,6 +72,54 @@ class ProfileService(BaseService):
         exists_statement = sa.select(sa.exists(statement))
         return await self.database.fetch_val(query=exists_statement)
 
+    async def get_sync_watermark(self, username: str) -> Optional[Tuple[datetime, str]]:
+        """Get the newest post a profile was synced up to.
+
+        :param username: username of the profile
+        :return: timestamp (naive UTC) and shortcode of the post, or None if the profile was never synced
+        """
+
+        statement = sa.select(
+            schema.profiles.c.sync_watermark_timestamp,
+            schema.profiles.c.sync_watermark_shortcode,
+        ).where(schema.profiles.c.username == username)
+        row = await self.database.fetch_one(statement)
+        if not row or row['sync_watermark_timestamp'] is None:
+            return None
+        return row['sync_watermark_timestamp'], row['sync_watermark_shortcode']
+
+    async def update_sync_watermark(self, username: str, failed_post: Optional[Tuple[datetime, str]] = None):
+        """Advance the sync watermark of a profile to its newest archived post, after a sync.
+
+        The watermark never moves back, so deleting archived posts doesn't make the next sync archive them again. If
+        a post failed to download, the watermark stays below it, so that the next sync tries it again, and the profile
+        isn't marked as synced.
+
+        :param username: username of the profile
+        :param failed_post: timestamp (naive UTC) and shortcode of the oldest post that failed to download
+        """
+
+        async with self.database.transaction():
+            statement = sa.select(schema.posts.c.timestamp, schema.posts.c.shortcode) \
+                .where(schema.posts.c.username == username) \
+                .order_by(schema.posts.c.timestamp.desc(), schema.posts.c.shortcode.desc()) \
+                .limit(1)
+            if failed_post:
+                statement = statement.where(sa.tuple_(schema.posts.c.timestamp, schema.posts.c.shortcode) < failed_post)
+            newest_post = await self.database.fetch_one(statement)
+            watermark = await self.get_sync_watermark(username)
+
+            updates = {} if failed_post else {'last_synced': datetime.now(timezone.utc)}
+            if newest_post and (watermark is None or (newest_post['timestamp'], newest_post['shortcode']) > watermark):
+                updates['sync_watermark_timestamp'] = newest_post['timestamp']
+                updates['sync_watermark_shortcode'] = newest_post['shortcode']
+            if not updates:
+                return
+            statement = sa.update(schema.profiles) \
+                .where(schema.profiles.c.username == username) \
+                .values(**updates)
+            await self.database.execute(statement)
+
     async def update(self, username: str, updates: ProfileUpdates):
         """Update a profile
 
@@ -83,11 +143,13 @@ class ProfileService(BaseService):
 
         # delete files
         try:
-            self.delete_file(self.profile_images_dir, f'{username}.jpg')
+            await self.delete_file(self.profile_images_dir, f'{username}.jpg')
             shutil.rmtree(self.thumb_images_dir.joinpath(username))
             shutil.rmtree(self.post_dir.joinpath(username))
         except FileNotFoundError:
             pass
+        if self.content_addressed_storage:
+            await asyncio.get_running_loop().run_in_executor(None, self._collect_blobs)
 
         # delete records in database
         schema.profiles.delete()
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional
+
+import instaloader
+
+from entities.rate_limits import RateLimit
+
+logger = logging.getLogger(__name__)
+
+# default requests per minute of each budget: GraphQL pagination, profile and other non-GraphQL lookups, CDN media
+DEFAULT_RATES = {'graphql': 30, 'profile': 10, 'media': 120}
+
+# factor the rate of a budget is multiplied by when Instagram pushes back
+DECREASE_FACTOR = 0.5
+
+
+class TokenBucket:
+    """A token bucket shared by threads and coroutines.
+
+    Tokens are reserved before waiting, so concurrent callers queue up behind each other instead of all waking up
+    at once when the bucket refills.
+    """
+
+    def __init__(self, rate: float, capacity: float, jitter: float):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens, i.e. the burst size
+        :param jitter: maximum random delay added to each wait, as a fraction of the interval between tokens
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.jitter = jitter
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, borrowing against future refills if the bucket is empty.
+
+        :return: seconds to wait before the token may be used
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return delay + random.uniform(0, self.jitter / self.rate)
+
+    def acquire(self):
+        """Wait for a token, blocking the thread."""
+
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        """Wait for a token without blocking the event loop."""
+
+        await asyncio.sleep(self.reserve())
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """A token bucket that adapts its rate with additive increase and multiplicative decrease.
+
+    The rate is lowered and the bucket paused whenever Instagram pushes back, and raised step by step after each
+    interval without push back, so it converges on the highest rate tolerated.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        jitter: float,
+        min_rate: float,
+        max_rate: float,
+        increase_step: float,
+        increase_interval: float,
+        pause: float,
+    ):
+        """
+        :param rate: initial tokens added per second
+        :param capacity: maximum number of tokens, i.e. the burst size
+        :param jitter: maximum random delay added to each wait, as a fraction of the interval between tokens
+        :param min_rate: lowest rate, in tokens per second
+        :param max_rate: highest rate, in tokens per second
+        :param increase_step: tokens per second added to the rate after each healthy interval
+        :param increase_interval: seconds without push back before the rate is increased
+        :param pause: seconds no tokens are handed out after push back
+        """
+
+        super().__init__(rate, capacity, jitter)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.increase_interval = increase_interval
+        self.pause = pause
+        self.changed = time.monotonic()
+        self.paused_until = 0.0
+        self.throttle_count = 0
+        self.last_throttled: Optional[datetime] = None
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            intervals = int((now - self.changed) // self.increase_interval)
+            if intervals > 0:
+                self.rate = min(self.max_rate, self.rate + intervals * self.increase_step)
+                self.changed += intervals * self.increase_interval
+            pause = max(0.0, self.paused_until - now)
+        return pause + super().reserve()
+
+    def throttle(self):
+        """Lower the rate and pause the bucket after Instagram pushed back.
+
+        Push back during a pause extends it, but doesn't lower the rate again, as concurrent requests tend to be
+        pushed back together.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+                self.throttle_count += 1
+                self.last_throttled = datetime.now(timezone.utc)
+            self.changed = now
+            self.tokens = min(self.tokens, 0)
+            self.paused_until = now + self.pause
+            logger.warning(f'Throttled to {self.rate * 60:.1f} requests per minute, pausing for {self.pause:.0f}s.')
+
+    def get_state(self, budget: str) -> RateLimit:
+        """Get the state of the bucket.
+
+        :param budget: the budget of the bucket
+        :return: the state
+        """
+
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            pause = self.paused_until - time.monotonic()
+            return RateLimit(
+                budget=budget,
+                rate=self.rate * 60,
+                throttle_count=self.throttle_count,
+                last_throttled=self.last_throttled,
+                paused_until=now + timedelta(seconds=pause) if pause > 0 else None,
+                updated=now,
+            )
+
+    def set_state(self, state: RateLimit):
+        """Restore the state of the bucket, e.g. from a previous run.
+
+        :param state: the state
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.rate = min(self.max_rate, max(self.min_rate, state.rate / 60))
+            self.throttle_count = state.throttle_count
+            self.last_throttled = state.last_throttled
+            if state.paused_until:
+                pause = (state.paused_until - datetime.now(timezone.utc)).total_seconds()
+                self.paused_until = max(self.paused_until, now + pause)
+
+
+# buckets shared by all Instagram-facing calls of the process, created on first use
+_buckets: Dict[str, AdaptiveTokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(budget: str) -> AdaptiveTokenBucket:
+    """Get the token bucket of a budget.
+
+    :param budget: graphql, profile or media
+    :return: the token bucket
+    """
+
+    with _buckets_lock:
+        if budget not in _buckets:
+            rate = float(os.getenv(f'RATE_LIMIT_{budget.upper()}', DEFAULT_RATES[budget])) / 60
+            _buckets[budget] = AdaptiveTokenBucket(
+                rate=rate,
+                capacity=float(os.getenv('RATE_LIMIT_BURST', 3)),
+                jitter=float(os.getenv('RATE_LIMIT_JITTER', 0.5)),
+                min_rate=float(os.getenv('RATE_LIMIT_MIN', 1)) / 60,
+                max_rate=float(os.getenv(f'RATE_LIMIT_{budget.upper()}_MAX', rate * 60 * 4)) / 60,
+                increase_step=float(os.getenv('RATE_LIMIT_INCREASE_STEP', 1)) / 60,
+                increase_interval=float(os.getenv('RATE_LIMIT_INCREASE_INTERVAL', 600)),
+                pause=float(os.getenv('RATE_LIMIT_PAUSE', 300)),
+            )
+        return _buckets[budget]
+
+
+def is_throttled(error: Exception) -> bool:
+    """Check if an instaloader error means Instagram is pushing back, i.e. a 429 or a redirect to the login page.
+
+    :param error: the error
+    :return: if requests should slow down
+    """
+
+    if isinstance(error, (instaloader.TooManyRequestsException, instaloader.LoginRequiredException)):
+        return True
+    if isinstance(error, (instaloader.ConnectionException, instaloader.AbortDownloadException)):
+        message = str(error).lower()
+        return '429' in message or 'redirected to login' in message
+    return False
+
+
+async def next_with_backoff(iterator: Iterator, budget: str = 'graphql'):
+    """Fetch the next item of an instaloader iterator in a thread.
+
+    When Instagram pushes back, the budget is throttled and the same item fetched again once the pause is over,
+    which instaloader iterators support as they only advance after a page was fetched.
+
+    :param iterator: the iterator
+    :param budget: the budget the iterator draws from
+    :return: the next item, or None if the iterator is exhausted
+    """
+
+    loop = asyncio.get_running_loop()
+    max_retries = int(os.getenv('RATE_LIMIT_MAX_RETRIES', 5))
+    retries = 0
+    while True:
+        try:
+            return await loop.run_in_executor(None, next, iterator, None)
+        except (instaloader.InstaloaderException, instaloader.AbortDownloadException) as e:
+            if not is_throttled(e) or retries >= max_retries:
+                raise
+            retries += 1
+            get_bucket(budget).throttle()
+            logger.warning(f'Instagram pushed back ({e}), resuming after a pause ({retries}/{max_retries}).')
+
+
+class RateController(instaloader.RateController):
+    """Makes instaloader queries wait for the shared token buckets, on top of its own sliding window limits."""
+
+    @staticmethod
+    def get_budget(query_type: str) -> str:
+        """Get the budget an instaloader query is charged to.
+
+        :param query_type: query hash or doc id of GraphQL queries, iphone or other for other endpoints
+        :return: the budget
+        """
+
+        return 'profile' if query_type in ['iphone', 'other'] else 'graphql'
+
+    def wait_before_query(self, query_type: str):
+        get_bucket(self.get_budget(query_type)).acquire()
+        super().wait_before_query(query_type)
+
+    def handle_429(self, query_type: str):
+        get_bucket(self.get_budget(query_type)).throttle()
+        super().handle_429(query_type)
@@ -1,13 +1,17 @@
 import os
 import uuid
-from sqlalchemy import MetaData, Table, Column, ForeignKey, Integer, Float, String, Boolean, DateTime
-from sqlalchemy.dialects.postgresql import ARRAY, UUID
+from sqlalchemy import MetaData, Table, Column, text, ForeignKey, Index, Integer, Float, String, Boolean, DateTime
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID
 
 database_url = (
     f"postgresql://{os.getenv('DATABASE_USERNAME', 'postgres')}:{os.getenv('DATABASE_PASSWORD', 'postgres')}"
     f"@{os.getenv('DATABASE_HOSTNAME', 'localhost')}:{os.getenv('DATABASE_PORT', 5432)}/insta_archiver"
 )
 
+# text search configuration of captions, simple as captions are in many languages
+text_search_config = 'simple'
+
 metadata = MetaData()
 
 profiles = Table(
@@ -19,20 +23,43 @@ profiles = Table(
     Column('biography', String, index=True, nullable=True),
     Column('image_filename', String, index=True, nullable=False),
     Column('auto_archive', Boolean, index=True, nullable=False),
+    Column('sync_watermark_timestamp', DateTime, nullable=True),
+    Column('sync_watermark_shortcode', String, nullable=True),
+    Column('last_synced', DateTime(timezone=True), nullable=True),
+    Index('ix_profiles_username_trgm', 'username', postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}),
+    Index(
+        'ix_profiles_full_name_trgm', 'full_name', postgresql_using='gin', postgresql_ops={'full_name': 'gin_trgm_ops'}
+    ),
+    Index(
+        'ix_profiles_display_name_trgm',
+        'display_name',
+        postgresql_using='gin',
+        postgresql_ops={'display_name': 'gin_trgm_ops'},
+    ),
 )
 
 posts = Table(
     'posts',
     metadata,
     Column('shortcode', String, primary_key=True),
-    Column('username', String, ForeignKey('profiles.username', ondelete='CASCADE'), index=True),
-    Column('timestamp', DateTime, index=True, nullable=False),
+    Column('username', String, ForeignKey('profiles.username', ondelete='CASCADE')),
+    Column('timestamp', DateTime, nullable=False),
     Column('type', String, index=True, nullable=False),
     Column('caption', String, index=True, nullable=True),
-    Column('caption_hashtags', ARRAY(String), index=True, nullable=False),
-    Column('caption_mentions', ARRAY(String), index=True, nullable=False),
+    Column('caption_hashtags', ARRAY(String), nullable=False),
+    Column('caption_mentions', ARRAY(String), nullable=False),
+    Index('ix_posts_caption_hashtags', 'caption_hashtags', postgresql_using='gin'),
+    Index('ix_posts_caption_mentions', 'caption_mentions', postgresql_using='gin'),
 )
 
+# text search vector of captions, indexed as an expression rather than stored, queries must repeat it to use the index
+caption_tsv = func.to_tsvector(text(f"'{text_search_config}'"), func.coalesce(posts.c.caption, text("''")))
+Index('ix_posts_caption_tsv', caption_tsv, postgresql_using='gin')
+
+# indexes matching the order posts are listed in, with and without a username filter
+Index('ix_posts_username_timestamp_shortcode', posts.c.username, posts.c.timestamp.desc(), posts.c.shortcode.desc())
+Index('ix_posts_timestamp_shortcode', posts.c.timestamp.desc(), posts.c.shortcode.desc())
+
 post_items = Table(
     'post_items',
     metadata,
@@ -50,11 +77,50 @@ tasks = Table(
     Column('id', UUID(as_uuid=False), primary_key=True, default=uuid.uuid4),
     Column('username', String, ForeignKey('profiles.username', ondelete='CASCADE'), index=True, nullable=True),
     Column('type', String, index=True, nullable=False),
-    Column('status', String, index=True, nullable=False),
+    Column('status', String, nullable=False),
     Column('created', DateTime(timezone=True), index=True, nullable=False),
     Column('started', DateTime(timezone=True), nullable=True),
     Column('completed', DateTime(timezone=True), nullable=True),
     Column('post_count', Integer, nullable=True),
     Column('time_range_start', DateTime(timezone=True), nullable=True),
     Column('time_range_end', DateTime(timezone=True), nullable=True),
-)
\ No newline at end of file
+    Column('attempts', Integer, server_default=text('0'), nullable=False),
+    Column('lease_expires', DateTime(timezone=True), nullable=True),
+    Column('checkpoint', JSONB, nullable=True),
+    Index('ix_tasks_status_created', 'status', 'created'),
+)
+
+failed_downloads = Table(
+    'failed_downloads',
+    metadata,
+    Column('path', String, primary_key=True),
+    Column('url', String, nullable=False),
+    Column('shortcode', String, index=True, nullable=True),
+    Column('reason', String, nullable=True),
+    Column('attempts', Integer, nullable=False),
+    Column('last_attempt', DateTime(timezone=True), nullable=False),
+)
+
+
+profile_post_stats = Table(
+    'profile_post_stats',
+    metadata,
+    Column('username', String, ForeignKey('profiles.username', ondelete='CASCADE'), primary_key=True),
+    Column('year', Integer, primary_key=True),
+    Column('quarter', Integer, primary_key=True),
+    Column('count', Integer, nullable=False),
+    Column('first_post_timestamp', DateTime, nullable=False),
+    Column('last_post_timestamp', DateTime, nullable=False),
+)
+
+
+rate_limits = Table(
+    'rate_limits',
+    metadata,
+    Column('budget', String, primary_key=True),
+    Column('rate', Float, nullable=False),
+    Column('throttle_count', Integer, nullable=False),
+    Column('last_throttled', DateTime(timezone=True), nullable=True),
+    Column('paused_until', DateTime(timezone=True), nullable=True),
+    Column('updated', DateTime(timezone=True), nullable=False),
+)
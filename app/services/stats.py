@@ -0,0 +1,185 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import sqlalchemy as sa
+from databases import Database
+from sqlalchemy.dialects.postgresql import insert
+
+from services import schema
+from services.base import BaseService
+
+logger = logging.getLogger(__name__)
+
+
+def _to_naive_utc(timestamp: datetime) -> datetime:
+    """Convert a timestamp to naive UTC, which is how post timestamps are stored.
+
+    :param timestamp: the timestamp
+    :return: the naive UTC timestamp
+    """
+
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _get_quarter(timestamp: datetime) -> Tuple[int, int]:
+    """Get the year and quarter of a timestamp.
+
+    :param timestamp: the timestamp
+    :return: the year and quarter
+    """
+
+    return timestamp.year, (timestamp.month - 1) // 3 + 1
+
+
+class ProfileStatsService(BaseService):
+    """Maintains the per profile, per quarter post stats rollup.
+
+    Callers are expected to run the maintenance methods in the same transaction as the post changes they reflect.
+    """
+
+    async def add(self, username: str, timestamp: datetime):
+        """Count a new post in the stats.
+
+        :param username: username of the post owner
+        :param timestamp: timestamp of the post
+        """
+
+        await self.add_many([(username, timestamp)])
+
+    async def add_many(self, posts: List[Tuple[str, datetime]]):
+        """Count new posts in the stats, with one statement.
+
+        :param posts: username of the owner and timestamp of each post
+        """
+
+        # aggregate the posts by profile and quarter first, a statement can't upsert the same row twice
+        aggregates = {}
+        for username, timestamp in posts:
+            if username is None:
+                continue
+            timestamp = _to_naive_utc(timestamp)
+            key = (username, *_get_quarter(timestamp))
+            if key in aggregates:
+                count, first_post_timestamp, last_post_timestamp = aggregates[key]
+                aggregates[key] = (
+                    count + 1, min(first_post_timestamp, timestamp), max(last_post_timestamp, timestamp)
+                )
+            else:
+                aggregates[key] = (1, timestamp, timestamp)
+        if not aggregates:
+            return
+
+        statement = insert(schema.profile_post_stats).values([
+            {
+                'username': username,
+                'year': year,
+                'quarter': quarter,
+                'count': count,
+                'first_post_timestamp': first_post_timestamp,
+                'last_post_timestamp': last_post_timestamp,
+            }
+            for (username, year, quarter), (count, first_post_timestamp, last_post_timestamp)
+            in sorted(aggregates.items())
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[
+                schema.profile_post_stats.c.username,
+                schema.profile_post_stats.c.year,
+                schema.profile_post_stats.c.quarter,
+            ],
+            set_={
+                'count': schema.profile_post_stats.c.count + statement.excluded.count,
+                'first_post_timestamp': sa.func.least(
+                    schema.profile_post_stats.c.first_post_timestamp, statement.excluded.first_post_timestamp
+                ),
+                'last_post_timestamp': sa.func.greatest(
+                    schema.profile_post_stats.c.last_post_timestamp, statement.excluded.last_post_timestamp
+                ),
+            },
+        )
+        await self.database.execute(statement)
+
+    async def refresh(self, username: str, timestamp: datetime):
+        """Recompute the stats of a profile in the quarter of a timestamp, e.g. after a post is removed.
+
+        Only the posts of the profile in that quarter are aggregated.
+
+        :param username: username of the profile
+        :param timestamp: a timestamp in the quarter
+        """
+
+        year, quarter = _get_quarter(_to_naive_utc(timestamp))
+        start = datetime(year, quarter * 3 - 2, 1)
+        end = datetime(year + 1, 1, 1) if quarter == 4 else datetime(year, quarter * 3 + 1, 1)
+
+        statement = sa.delete(schema.profile_post_stats).where(
+            schema.profile_post_stats.c.username == username,
+            schema.profile_post_stats.c.year == year,
+            schema.profile_post_stats.c.quarter == quarter,
+        )
+        await self.database.execute(statement)
+        await self._insert_aggregates(
+            schema.posts.c.username == username,
+            schema.posts.c.timestamp >= start,
+            schema.posts.c.timestamp < end,
+        )
+
+    async def rebuild(self, usernames: Optional[List[str]] = None):
+        """Rebuild the stats from the posts table.
+
+        :param usernames: usernames of the profiles to rebuild the stats of, all profiles if not provided
+        """
+
+        async with self.database.transaction():
+            statement = sa.delete(schema.profile_post_stats)
+            conditions = []
+            if usernames is not None:
+                statement = statement.where(schema.profile_post_stats.c.username.in_(usernames))
+                conditions.append(schema.posts.c.username.in_(usernames))
+            await self.database.execute(statement)
+            await self._insert_aggregates(*conditions)
+
+    async def _insert_aggregates(self, *conditions):
+        """Aggregate posts by profile and quarter into the stats table.
+
+        :param conditions: conditions selecting the posts to aggregate
+        """
+
+        year = sa.cast(sa.func.date_part('year', schema.posts.c.timestamp), sa.INT)
+        quarter = sa.cast(sa.func.date_part('quarter', schema.posts.c.timestamp), sa.INT)
+        select_statement = sa.select(
+            schema.posts.c.username,
+            year.label('year'),
+            quarter.label('quarter'),
+            sa.func.count().label('count'),
+            sa.func.min(schema.posts.c.timestamp).label('first_post_timestamp'),
+            sa.func.max(schema.posts.c.timestamp).label('last_post_timestamp'),
+        ).where(
+            schema.posts.c.username.isnot(None), *conditions
+        ).group_by(
+            schema.posts.c.username, sa.literal_column('year'), sa.literal_column('quarter')
+        )
+        statement = insert(schema.profile_post_stats).from_select(
+            ['username', 'year', 'quarter', 'count', 'first_post_timestamp', 'last_post_timestamp'],
+            select_statement,
+        )
+        await self.database.execute(statement)
+
+
+if __name__ == '__main__':
+    # rebuild the stats of all profiles, e.g. python -m services.stats
+    async def main():
+        database = Database(schema.database_url)
+        await database.connect()
+        try:
+            await ProfileStatsService(database, None).rebuild()
+            logger.info('Rebuilt profile post stats.')
+        finally:
+            await database.disconnect()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
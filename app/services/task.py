@@ -1,15 +1,18 @@
 import asyncio
 import logging
 import os
-import random
+import time
 
 import instaloader
-from datetime import timezone
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Iterator, Optional, Set, Tuple
 from entities.enums import TaskType
 from entities.tasks import Task
 from services.post import PostService
+from services.profile import ProfileService
 from .base import BaseService
-from .crud import TaskCRUDService
+from .crud import RateLimitCRUDService, TaskCRUDService
+from .rate_limit import next_with_backoff
 
 logger = logging.getLogger(__name__)
 
@@ -19,34 +22,73 @@ class TaskExecutor(BaseService):
         super().__init__(*args, **kwargs)
         self.task_crud_service = TaskCRUDService(*args, **kwargs)
         self.post_crud_service = PostService(*args, **kwargs)
+        self.rate_limit_crud_service = RateLimitCRUDService(*args, **kwargs)
+        self.heartbeat_interval = float(os.getenv('TASK_HEARTBEAT_INTERVAL', 30))
+        self.pipeline_depth = int(os.getenv('PIPELINE_DEPTH', 8))
+        self.pipeline_batch_size = int(os.getenv('PIPELINE_BATCH_SIZE', 20))
+        self.checkpoint_interval = float(os.getenv('TASK_CHECKPOINT_INTERVAL', 60))
 
     async def run_tasks(self):
         """Run all tasks one after another."""
 
-        while task := await self.task_crud_service.get_next():
-            await self.task_crud_service.set_in_progress(task)
+        await self.task_crud_service.reap_expired()
+        await self.rate_limit_crud_service.load()
+        while task := await self.task_crud_service.claim_next():
             logger.debug(f'Executing task: {task}')
 
+            run = asyncio.ensure_future(self._run_task(task))
+            heartbeat = asyncio.ensure_future(self._heartbeat(task, run))
             try:
-                if task.type == TaskType.CATCH_UP:
-                    await self._run_catch_up_task(task)
-                elif task.type == TaskType.SAVED_POSTS:
-                    await self._run_saved_posts_task(task)
-                elif task.type == TaskType.TIME_RANGE:
-                    await self._run_time_range_task(task)
-                else:
-                    raise NotImplemented('Unrecognized task type')
+                await run
                 await self.task_crud_service.set_succeeded(task)
                 logger.info(f'Task succeeded: {task}')
+            except asyncio.CancelledError:
+                # the heartbeat stops the task once it lost its lease, another executor may be running it by now
+                if not heartbeat.done():
+                    raise
+                logger.warning(f'Stopped task after losing its lease: {task}')
             except Exception as e:
                 await self.task_crud_service.set_failed(task)
                 logger.error(f'Task failed: {task}, {e}', exc_info=True)
+            finally:
+                heartbeat.cancel()
+            await self.rate_limit_crud_service.save()
+            await self.task_crud_service.reap_expired()
 
-    async def _sleep(self):
-        """Sleep for a random amount of time."""
+    async def _run_task(self, task: Task):
+        """Run a task according to its type.
 
-        max_sleep = os.environ.get('MAX_SLEEP', 30)
-        await asyncio.sleep(random.randint(10, max_sleep))
+        :param task: the task to run
+        """
+
+        if task.type == TaskType.CATCH_UP:
+            await self._run_catch_up_task(task)
+        elif task.type == TaskType.SAVED_POSTS:
+            await self._run_saved_posts_task(task)
+        elif task.type == TaskType.TIME_RANGE:
+            await self._run_time_range_task(task)
+        else:
+            raise NotImplementedError('Unrecognized task type')
+
+    async def _heartbeat(self, task: Task, run: asyncio.Future):
+        """Keep renewing the lease on a task while it runs, and saving the rate limit state.
+
+        The task is cancelled if its lease can't be renewed because it was reaped, as it may be claimed again.
+
+        :param task: the running task
+        :param run: the future running the task
+        """
+
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.rate_limit_crud_service.save()
+                if not await self.task_crud_service.renew_lease(task):
+                    logger.warning(f'Lost the lease on task: {task}')
+                    run.cancel()
+                    return
+            except Exception as e:
+                logger.warning(f'Failed to renew the lease on task: {task}, {e}')
 
     async def _get_profile(self, username) -> instaloader.Profile:
         """Get instaloader profile for a user.
@@ -72,33 +114,26 @@ class TaskExecutor(BaseService):
         loop = asyncio.get_running_loop()
         profile = await self._get_profile(task.username)
         post_iterator = await loop.run_in_executor(None, profile.get_posts)
-        task.post_count = 0
 
-        while True:
-            # sleep for a random amount of time
-            await self._sleep()
-
-            # fetch the next post
-            try:
-                post: instaloader.Post = await loop.run_in_executor(None, next, post_iterator)
-            except StopIteration:
-                logger.debug('Unable to get the next post.')
-                break
+        profile_service = ProfileService(self.database, self.http_session)
+        watermark = await profile_service.get_sync_watermark(task.username)
 
+        async def select(post: instaloader.Post, existing: Set[str]) -> Optional[bool]:
             # skip pinned posts
             if post.is_pinned:
-                continue
+                return False
 
-            # complete task if a post already exists
-            if await self.post_crud_service.exists(post.shortcode):
-                break
+            # complete task once the newest post of the last sync is reached, skipping posts archived since
+            if watermark:
+                return post.shortcode not in existing if (post.date_utc, post.shortcode) > watermark else None
 
-            # save post
-            await self.post_crud_service.create_from_instaloader(post)
-            task.post_count += 1
+            # complete task if a post already exists, for profiles that were never synced
+            if post.shortcode in existing:
+                return None
+            return True
 
-            # update post count
-            await self.task_crud_service.set_post_count(task)
+        failed_post = await self._run_pipeline(task, post_iterator, select, check_exists=True)
+        await profile_service.update_sync_watermark(task.username, failed_post)
 
     async def _run_saved_posts_task(self, task: Task):
         """Run saved posts task.
@@ -109,29 +144,14 @@ class TaskExecutor(BaseService):
         loop = asyncio.get_running_loop()
         profile = await self._get_profile(self.instagram_username)
         post_iterator = await loop.run_in_executor(None, profile.get_saved_posts)
-        task.post_count = 0
-
-        while True:
-            # sleep for a random amount of time
-            await self._sleep()
-
-            # fetch the next post
-            try:
-                post: instaloader.Post = await loop.run_in_executor(None, next, post_iterator)
-            except StopIteration:
-                logger.debug('Unable to get the next post.')
-                break
 
+        async def select(post: instaloader.Post, existing: Set[str]) -> Optional[bool]:
             # complete task if a post already exists
-            if await self.post_crud_service.exists(post.shortcode):
-                break
+            if post.shortcode in existing:
+                return None
+            return True
 
-            # save post
-            await self.post_crud_service.create_from_instaloader(post)
-            task.post_count += 1
-
-            # update post count
-            await self.task_crud_service.set_post_count(task)
+        await self._run_pipeline(task, post_iterator, select, check_exists=True)
 
     async def _run_time_range_task(self, task: Task):
         """Run time range task.
@@ -142,36 +162,235 @@ class TaskExecutor(BaseService):
         loop = asyncio.get_running_loop()
         profile = await self._get_profile(task.username)
         post_iterator = await loop.run_in_executor(None, profile.get_posts)
-        task.post_count = 0
-
-        while True:
-            # sleep for a random amount of time
-            await self._sleep()
-
-            # fetch the next post
-            try:
-                post: instaloader.Post = await loop.run_in_executor(None, next, post_iterator)
-            except StopIteration:
-                logger.debug('Unable to get the next post.')
-                break
 
+        async def select(post: instaloader.Post, existing: Set[str]) -> Optional[bool]:
             # skip pinned posts
             if post.is_pinned:
-                continue
+                return False
 
             # if post is later than the end date, that means we have yet to reach posts within the time range
             if post.date_utc.replace(tzinfo=timezone.utc) >= task.time_range_end:
                 logger.debug(f'Post date {post.date_utc} is later than the end date.')
-                continue
+                return False
 
             # if post is earlier than the start date, that means we have iterated through posts within the time range
             if post.date_utc.replace(tzinfo=timezone.utc) < task.time_range_start:
                 logger.debug(f'Post date {post.date_utc} is earlier than the start date.')
-                break
+                return None
+            return True
+
+        await self._run_pipeline(task, post_iterator, select)
+
+    async def _run_pipeline(
+        self,
+        task: Task,
+        post_iterator: Iterator[instaloader.Post],
+        select: Callable[[instaloader.Post, Set[str]], Awaitable[Optional[bool]]],
+        check_exists: bool = False,
+    ) -> Optional[Tuple[datetime, str]]:
+        """Archive posts from an iterator in a pipeline of fetch, download and persist stages.
+
+        Post metadata is fetched ahead while the media of earlier posts is downloading, and downloaded posts are
+        saved in batches in the order they were fetched. At most pipeline_depth posts are in flight, fetching
+        waits for the later stages beyond that. The iteration resumes from the checkpoint of the task, if it has
+        one.
+
+        :param task: the running task
+        :param post_iterator: iterator of the posts to archive
+        :param select: tells if a fetched post should be archived (True), skipped (False), or if the iteration
+        should stop (None), given the shortcodes of the fetched posts that are archived already
+        :param check_exists: if select needs to know which posts are archived already, otherwise it is given none
+        :return: timestamp (naive UTC) and shortcode of the oldest post that failed to download, including those
+        before the checkpoint, or None if none failed
+        """
+
+        checkpoint = await self._resume(task, post_iterator)
+        resume_shortcode, failed_post = None, None
+        if checkpoint:
+            resume_shortcode = checkpoint['shortcode']
+            if checkpoint.get('failed_post'):
+                timestamp, shortcode = checkpoint['failed_post']
+                failed_post = datetime.fromisoformat(timestamp), shortcode
+
+        queue = asyncio.Queue(maxsize=self.pipeline_depth)
+        fetch_stage = asyncio.ensure_future(
+            self._fetch_posts(post_iterator, select, queue, resume_shortcode, check_exists)
+        )
+        try:
+            failed_post = await self._persist_posts(task, queue, failed_post)
+            await fetch_stage
+            return failed_post
+        finally:
+            fetch_stage.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None and item[0] is not None:
+                    item[0].cancel()
+
+    async def _resume(self, task: Task, post_iterator: Iterator[instaloader.Post]) -> Optional[dict]:
+        """Restore the iterator and post count of a task from its checkpoint.
+
+        :param task: the running task
+        :param post_iterator: iterator of the posts to archive, which hasn't been used yet
+        :return: the checkpoint, with the shortcode of the last post handled before it, which the iterator yields
+        again, or None if the task starts over
+        """
+
+        task.post_count = 0
+        checkpoint = await self.task_crud_service.get_checkpoint(task)
+        if not checkpoint or not isinstance(post_iterator, instaloader.NodeIterator):
+            return None
+
+        frozen = instaloader.FrozenNodeIterator(**checkpoint['iterator'])
+        if frozen.best_before and datetime.fromtimestamp(frozen.best_before) < datetime.now():
+            logger.info(f'Checkpoint of task expired, starting over: {task}')
+            return None
+        try:
+            post_iterator.thaw(frozen)
+        except instaloader.InvalidArgumentException as e:
+            logger.info(f'Checkpoint of task does not match, starting over: {task}, {e}')
+            return None
+
+        task.post_count = checkpoint['post_count']
+        logger.info(f'Resuming task from post {checkpoint["shortcode"]}: {task}')
+        return checkpoint
+
+    @staticmethod
+    def _freeze(post_iterator: Iterator[instaloader.Post], post: instaloader.Post) -> Optional[dict]:
+        """Create a checkpoint of an iterator, right after it yielded a post.
+
+        :param post_iterator: iterator of the posts to archive
+        :param post: the post just yielded
+        :return: the checkpoint, or None if the iterator can't be resumed
+        """
 
-            # save post
-            await self.post_crud_service.create_from_instaloader(post)
-            task.post_count += 1
+        if not isinstance(post_iterator, instaloader.NodeIterator):
+            return None
+        return {'iterator': post_iterator.freeze()._asdict(), 'shortcode': post.shortcode}
+
+    async def _fetch_posts(
+        self,
+        post_iterator: Iterator[instaloader.Post],
+        select: Callable[[instaloader.Post, Set[str]], Awaitable[Optional[bool]]],
+        queue: asyncio.Queue,
+        resume_shortcode: Optional[str] = None,
+        check_exists: bool = False,
+    ):
+        """Fetch posts and start downloading the selected ones, the fetch stage of the pipeline.
+
+        Posts are fetched in chunks of up to pipeline_depth, ending at the first post that may be archived already,
+        so that they are looked up with one query per chunk. Each fetched post is queued with a checkpoint, and without a download if it was skipped.
+
+        :param post_iterator: iterator of the posts to archive
+        :param select: tells if a fetched post should be archived, skipped, or if the iteration should stop
+        :param queue: queue of downloads, checkpoints and posts for the persist stage, ended with None
+        :param resume_shortcode: shortcode of the post the iterator was resumed at, which was already handled
+        :param check_exists: if select needs to know which posts are archived already
+        """
+
+        try:
+            is_stopped = False
+            while not is_stopped:
+                # fetch the next chunk of posts, pausing in place if Instagram pushes back
+                chunk = []
+                while len(chunk) < self.pipeline_depth:
+                    post: instaloader.Post = await next_with_backoff(post_iterator)
+                    if post is None:
+                        logger.debug('Unable to get the next post.')
+                        is_stopped = True
+                        break
+                    checkpoint = self._freeze(post_iterator, post)
+
+                    # skip the post the iterator was resumed at
+                    if resume_shortcode is not None:
+                        is_resumed_post = post.shortcode == resume_shortcode
+                        resume_shortcode = None
+                        if is_resumed_post:
+                            continue
+                    chunk.append((post, checkpoint))
+
+                    # end the chunk at the first post that may be archived already, select may stop there
+                    if check_exists and self.post_crud_service.might_exist(post.shortcode):
+                        break
+
+                shortcodes = [post.shortcode for post, _ in chunk]
+                existing = await self.post_crud_service.exists_many(shortcodes) if check_exists else set()
+                for post, checkpoint in chunk:
+                    selected = await select(post, existing)
+                    if selected is None:
+                        is_stopped = True
+                        break
+                    if selected:
+                        download = self.post_crud_service.create_from_instaloader(post, persist=False)
+                        await queue.put((asyncio.ensure_future(download), checkpoint, post))
+                    else:
+                        await queue.put((None, checkpoint, post))
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    async def _persist_posts(
+        self,
+        task: Task,
+        queue: asyncio.Queue,
+        failed_post: Optional[Tuple[datetime, str]] = None,
+    ) -> Optional[Tuple[datetime, str]]:
+        """Save downloaded posts in batches, the persist stage of the pipeline.
+
+        A batch is saved once it is full, or as soon as the next download isn't queued yet. The checkpoint is saved
+        only when every post fetched before it has been saved, along with batches and at least every
+        checkpoint_interval seconds.
+
+        :param task: the running task
+        :param queue: queue of downloads, checkpoints and posts from the fetch stage, ended with None
+        :param failed_post: timestamp (naive UTC) and shortcode of the oldest post that failed to download before
+        :return: timestamp (naive UTC) and shortcode of the oldest post that failed to download, or None
+        """
+
+        batch, checkpoint = [], None
+        checkpoint_saved = time.monotonic()
+        while True:
+            item = await queue.get()
+            if item is not None:
+                download, checkpoint, instaloader_post = item
+                if download is not None:
+                    if post := await download:
+                        batch.append(post)
+                    elif not failed_post or (instaloader_post.date_utc, instaloader_post.shortcode) < failed_post:
+                        failed_post = instaloader_post.date_utc, instaloader_post.shortcode
+
+            if batch and (item is None or len(batch) >= self.pipeline_batch_size or queue.empty()):
+                await self.post_crud_service.upsert_many(batch)
+                logger.info(f'Saved {len(batch)} post(s) of task: {task}')
+                task.post_count += len(batch)
+                batch = []
+                await self._save_progress(task, checkpoint, failed_post)
+                checkpoint_saved = time.monotonic()
+            elif not batch and checkpoint and time.monotonic() - checkpoint_saved >= self.checkpoint_interval:
+                await self._save_progress(task, checkpoint, failed_post)
+                checkpoint_saved = time.monotonic()
+
+            if item is None:
+                return failed_post
+
+    async def _save_progress(
+        self,
+        task: Task,
+        checkpoint: Optional[dict],
+        failed_post: Optional[Tuple[datetime, str]] = None,
+    ):
+        """Save the post count of a task, and its checkpoint if it can be resumed, along with the oldest post that
+        failed to download before it.
+
+        :param task: the running task
+        :param checkpoint: the checkpoint to resume from
+        :param failed_post: timestamp (naive UTC) and shortcode of the oldest post that failed to download
+        """
 
-            # update post count
+        if checkpoint:
+            failed_post = [failed_post[0].isoformat(), failed_post[1]] if failed_post else None
+            checkpoint = {**checkpoint, 'post_count': task.post_count, 'failed_post': failed_post}
+            await self.task_crud_service.set_checkpoint(task, checkpoint)
+        else:
             await self.task_crud_service.set_post_count(task)
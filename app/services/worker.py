@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Optional
+
+import aiohttp
+from databases import Database
+
+from services import schema
+from services.crud.task import TASKS_CHANNEL
+from services.post import PostService
+from services.task import TaskExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """Runs task executors outside of the web server.
+
+    Executors drain the task queue, then wait until a task is created or the poll interval has passed.
+    """
+
+    def __init__(self, database: Database, http_session: aiohttp.ClientSession):
+        self.database = database
+        self.http_session = http_session
+        self.concurrency = int(os.getenv('WORKER_CONCURRENCY', 1))
+        self.poll_interval = float(os.getenv('WORKER_POLL_INTERVAL', 30))
+        self.wakeup: Optional[asyncio.Event] = None
+
+    async def run(self):
+        """Run the executors until cancelled."""
+
+        self.wakeup = asyncio.Event()
+        async with self.database.connection() as connection:
+            await connection.raw_connection.add_listener(TASKS_CHANNEL, self._on_notification)
+            logger.info(f'Worker started with {self.concurrency} executor(s).')
+            await asyncio.gather(
+                PostService(self.database, self.http_session).track_known_shortcodes(),
+                *[self._run_executor() for _ in range(self.concurrency)],
+            )
+
+    def _on_notification(self, *args):
+        """Wake up the executors when a task is created."""
+
+        self.wakeup.set()
+
+    async def _run_executor(self):
+        """Run tasks whenever there are any."""
+
+        executor = TaskExecutor(self.database, self.http_session)
+        while True:
+            self.wakeup.clear()
+            await executor.run_tasks()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main():
+    # stop on termination signals, tasks are left where they are
+    main_task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signal_number, main_task.cancel)
+
+    database = Database(schema.database_url)
+    http_session = aiohttp.ClientSession()
+    await database.connect()
+    try:
+        await Worker(database, http_session).run()
+    except asyncio.CancelledError:
+        logger.info('Worker stopped.')
+    finally:
+        await database.disconnect()
+        await http_session.close()
+
+
+if __name__ == '__main__':
+    # run a worker, e.g. python -m services.worker
+    logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO'))
+    asyncio.run(main())
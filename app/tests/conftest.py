@@ -0,0 +1,31 @@
+import os
+import sys
+
+import psycopg2
+import pytest
+
+# run from the app dir, like the app itself, so that its modules import the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('USER_ID', '')
+os.environ.setdefault('GROUP_ID', '')
+
+from services import schema  # noqa: E402
+
+
+@pytest.fixture
+def connection():
+    """Connect to the database of the app, which has to be migrated to the latest revision.
+
+    Tests using the database are skipped if it can't be reached. Everything runs in a transaction that is rolled
+    back afterwards.
+    """
+
+    try:
+        connection = psycopg2.connect(schema.database_url)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'database unavailable: {e}')
+    try:
+        yield connection
+    finally:
+        connection.rollback()
+        connection.close()
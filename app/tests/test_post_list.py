@@ -0,0 +1,65 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects.postgresql import psycopg2
+
+from services.post import PostService, _encode_cursor
+
+
+def explain(connection, query) -> dict:
+    """Get the plan of a query.
+
+    :param connection: the database connection
+    :param query: the query
+    :return: the root node of the plan
+    """
+
+    compiled = query.compile(dialect=psycopg2.dialect())
+    with connection.cursor() as cursor:
+        # the tables are small or empty, make the planner cost plans as it would for an archive of any size
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params)
+        return cursor.fetchone()[0][0]['Plan']
+
+
+def find_scans(node: dict, relation: str, ancestors=()):
+    """Find the scans of a table in a plan, along with the nodes above them.
+
+    :param node: the node to search from
+    :param relation: name of the table
+    :param ancestors: nodes above the node, the closest last
+    :return: pairs of scan nodes and their ancestors
+    """
+
+    if node.get('Relation Name') == relation:
+        yield node, ancestors
+    for child in node.get('Plans', []):
+        yield from find_scans(child, relation, ancestors + (node,))
+
+
+def list_queries(**kwargs):
+    service = PostService(None, None)
+    query, _, _ = service._build_list_queries(0, 10, **kwargs)
+    return query
+
+
+cursor = _encode_cursor(SimpleNamespace(timestamp=datetime(2021, 1, 1), shortcode='B'), is_backward=False)
+
+
+@pytest.mark.parametrize('kwargs, index_name', [
+    ({}, 'ix_posts_timestamp_shortcode'),
+    ({'cursor': cursor}, 'ix_posts_timestamp_shortcode'),
+    ({'username': 'user'}, 'ix_posts_username_timestamp_shortcode'),
+    ({'username': 'user', 'cursor': cursor}, 'ix_posts_username_timestamp_shortcode'),
+])
+def test_list_reads_posts_in_index_order(connection, kwargs, index_name):
+    # posts are read through the listing index and the limit applies to the scan, with no sort in between
+    scans = list(find_scans(explain(connection, list_queries(**kwargs)), 'posts'))
+    assert len(scans) == 1
+    scan, ancestors = scans[0]
+    assert scan['Node Type'] in ['Index Scan', 'Index Only Scan']
+    assert scan['Index Name'] == index_name
+    node_types = [node['Node Type'] for node in reversed(ancestors)]
+    assert 'Limit' in node_types
+    assert 'Sort' not in node_types[:node_types.index('Limit')]
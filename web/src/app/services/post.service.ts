@@ -109,4 +109,12 @@ export class PostService {
   getPosterPath(username: string, filename: string): string {
     return `${environment.apiRoot}/media/thumb_images/${username}/${filename}`;
   }
+
+  getMediaThumbnailPath(username: string, filename: string, width: number = 480): string {
+    return `${environment.apiRoot}/derivatives/posts/${username}/${filename}?width=${width}`;
+  }
+
+  getPosterThumbnailPath(username: string, filename: string, width: number = 480): string {
+    return `${environment.apiRoot}/derivatives/thumb_images/${username}/${filename}?width=${width}`;
+  }
 }
\ No newline at end of file